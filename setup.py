@@ -22,7 +22,6 @@ setup(
     install_requires=[
         'numpy',
         'scipy',
-        'autograd',
         'matplotlib',
         'pandas',
         'h5py',
@@ -0,0 +1,154 @@
+import hashlib
+import os
+import time
+
+import h5py
+import numpy as np
+
+
+def checkpoint_key(*parts):
+    """Hash of the inputs of a sweep; a checkpoint is only resumed if the
+    inputs match."""
+    sha = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            sha.update(f"{part.dtype.str}{part.shape}".encode())
+            sha.update(part.tobytes())
+        else:
+            sha.update(repr(part).encode())
+        sha.update(b"\x00")
+    return sha.hexdigest()
+
+
+def reuse_index(group, size, inputs=None, labels=None, tol=0.0):
+    """Item of a checkpoint group that each of size new items can take the
+    result of, -1 if none.
+
+    Items are paired by label if both have labels, otherwise by index; with
+    inputs, a pair is only kept if all inputs are within tol (NaN matching
+    NaN).
+    """
+    old = np.full(size, -1)
+    n_old = group["done"].shape[0]
+    if labels is not None and "labels" in group:
+        position = {label: i for i, label in
+                    enumerate(group["labels"].asstr()[...])}
+        for i, label in enumerate(labels):
+            old[i] = position.get(str(label), -1)
+    elif inputs is not None or n_old == size:
+        old[:min(size, n_old)] = np.arange(min(size, n_old))
+    if inputs is None:
+        return old
+    if "inputs" not in group:
+        return np.full(size, -1)
+    inputs = np.asarray(inputs, dtype=np.float64).reshape(size, -1)
+    old_inputs = group["inputs"][...]
+    if old_inputs.shape[1] != inputs.shape[1]:
+        return np.full(size, -1)
+    paired = old >= 0
+    delta = np.abs(inputs[paired] - old_inputs[old[paired]])
+    same = np.isnan(inputs[paired]) == np.isnan(old_inputs[old[paired]])
+    close = np.all(same & ~(delta > tol), axis=1)
+    old[np.flatnonzero(paired)[~close]] = -1
+    return old
+
+
+def _copy_without(path, name):
+    """Replace the HDF5 file at path by a copy without the group name."""
+    tmp = f"{path}.tmp"
+    with h5py.File(path, "r") as src, h5py.File(tmp, "w") as dst:
+        dst.attrs.update(src.attrs)
+        for other in src:
+            if other != name:
+                src.copy(src[other], dst)
+    os.replace(tmp, path)
+
+
+class Checkpoint:
+    """Results of a sweep of solves, streamed to a chunked HDF5 file.
+
+    The group ``name`` of the file holds ``values`` (size, n_value), NaN
+    until solved, and ``done``, the completion mask, along with the
+    ``inputs`` (e.g. the energies) and ``labels`` (e.g. the catalyst names)
+    of the items if given, next to the groups of other sweeps. Without
+    ``resume`` the group is started afresh.
+    With it the results of a previous run with the same key are kept: per
+    item if inputs are given, for the item of the same label (or index)
+    whose inputs are all within ``tol`` of the new ones, otherwise all of
+    them if the size is the same. Writes are buffered and flushed every
+    ``every`` s.
+    """
+
+    def __init__(self, path, name, size, n_value, key, resume=False,
+                 every=5.0, inputs=None, labels=None, tol=0.0):
+        try:
+            self.file = h5py.File(path, "a")
+        except OSError:
+            # left unreadable by a killed run
+            print(f"Cannot read {path}, starting a new checkpoint")
+            os.remove(path)
+            self.file = h5py.File(path, "a")
+        values = np.full((size, n_value), np.nan)
+        done = np.zeros(size, dtype=bool)
+        group = self.file.get(name)
+        if group is not None and resume:
+            if group.attrs.get("key") != key or \
+                    group["values"].shape[1] != n_value:
+                print(f"Inputs changed since the checkpoint of {name}, "
+                      "starting over")
+            else:
+                old = reuse_index(group, size, inputs, labels, tol)
+                kept = old >= 0
+                values[kept] = group["values"][...][old[kept]]
+                done[kept] = group["done"][...][old[kept]]
+                if inputs is not None:
+                    print(f"Reusing {done.sum()} of {size} results "
+                          f"of {name}")
+        if group is not None:
+            # HDF5 never reclaims the space of a deleted group, the file is
+            # rebuilt without it instead
+            self.file.close()
+            _copy_without(path, name)
+            self.file = h5py.File(path, "a")
+        group = self.file.create_group(name)
+        group.attrs["key"] = key
+        chunk = max(1, min(size, 4096))
+        group.create_dataset("values", data=values, chunks=(chunk, n_value))
+        group.create_dataset("done", data=done, chunks=(chunk,))
+        if inputs is not None:
+            inputs = np.asarray(inputs, dtype=np.float64).reshape(size, -1)
+            group.create_dataset("inputs", data=inputs,
+                                 chunks=(chunk, inputs.shape[1]))
+        if labels is not None:
+            group.create_dataset("labels", data=[str(l) for l in labels],
+                                 dtype=h5py.string_dtype())
+        self.file.flush()
+        self.group = group
+        self.values = values
+        self.done = done
+        self.every = every
+        self._pending = []
+        self._last = time.monotonic()
+
+    def write(self, index, value):
+        """Record the value(s) of item(s) index."""
+        self.values[index] = value
+        self.done[index] = True
+        self._pending.append(np.atleast_1d(index))
+        if time.monotonic() - self._last > self.every:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            index = np.unique(np.concatenate(self._pending))
+            self.group["values"][index] = self.values[index]
+            self.group["done"][index] = True
+            self.file.flush()
+            self._pending = []
+        self._last = time.monotonic()
+
+    def close(self):
+        if self.file:
+            self.flush()
+            self.file.close()
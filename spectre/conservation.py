@@ -0,0 +1,115 @@
+import numpy as np
+from scipy.sparse import issparse
+
+from qssa import split_species
+
+_LAWS = {}
+
+
+def conservation_laws(network, states, initial_conc):
+    """The catalyst total of a compiled network and the state it fixes.
+
+    Every step converts catalyst states into one another, so their sum is
+    conserved. The catalyst state with the largest initial concentration is
+    made dependent: it is left out of the error control of the solver and
+    rebuilt as the total minus the other states. Products, the other
+    obvious choice, start at zero; rebuilt from a difference of totals of
+    order one, they come out as rounding noise around zero that the fast
+    reverse steps turn into real fluxes.
+
+    Returns
+    -------
+    laws : dict
+        ind_idx, dep_idx : integrated and dependent species
+        link : (n_dep, n_ind) matrix with dy_dep = link dy_ind
+    """
+    key = (network["stoich"].tobytes(), network["stoich"].shape,
+           tuple(states), np.asarray(initial_conc, dtype=np.float64).tobytes())
+    if key in _LAWS:
+        return _LAWS[key]
+
+    cat_idx, _ = split_species(states)
+    total = np.zeros(network["n_species"])
+    total[cat_idx] = 1
+    if cat_idx.size and np.allclose(np.dot(network["stoich"].T, total), 0):
+        dep_idx = cat_idx[[np.argmax(np.asarray(initial_conc)[cat_idx])]]
+    else:
+        dep_idx = np.array([], dtype=int)
+    ind_idx = np.setdiff1d(np.arange(network["n_species"]), dep_idx)
+
+    laws = {
+        "ind_idx": ind_idx,
+        "dep_idx": dep_idx,
+        "link": -total[None, ind_idx] * total[dep_idx, None],
+    }
+    _LAWS[key] = laws
+    return laws
+
+
+def conservation_system(dydt, states, initial_conc):
+    """Reduce the ODE of system_KE_DE to its independent species.
+
+    ``dydt`` is the full right-hand side (with ``jac`` and ``network``);
+    the dependent species are rebuilt from the conserved totals of
+    ``initial_conc``, so mass balances hold to rounding error.
+
+    Rounding in the difference can still take the rebuilt state slightly
+    below zero; it is held at zero in the rates. ``undershoot_event(atol)``
+    is a terminal event for the solver that fires once it gets below -atol
+    anyway: the reduced solve is then not to be trusted.
+
+    The reduced ``dydt(t, z)`` has the same attributes as the full one plus
+    ``state_idx``, the species integrated, and ``expand``, which rebuilds full
+    concentrations (n_species, n_t) from z (n_ind, n_t).
+    """
+    initial_conc = np.asarray(initial_conc, dtype=np.float64)
+    laws = conservation_laws(dydt.network, states, initial_conc)
+    ind_idx = laws["ind_idx"]
+    dep_idx = laws["dep_idx"]
+    link = laws["link"]
+    z0 = initial_conc[ind_idx]
+    y = initial_conc.copy()
+
+    def _dep(z):
+        return initial_conc[dep_idx] + np.dot(link, z - z0)
+
+    def _full(z):
+        y[ind_idx] = z
+        y[dep_idx] = np.maximum(_dep(z), 0)
+        return y
+
+    def _dydt(t, z):
+        return dydt(t, _full(z))[ind_idx]
+
+    def _jac(t, z):
+        J = dydt.jac(t, _full(z))
+        if issparse(J):
+            J = J.toarray()
+        # species held at zero do not move with z
+        active = _dep(z) > 0
+        return J[np.ix_(ind_idx, ind_idx)] + \
+            np.dot(J[np.ix_(ind_idx, dep_idx[active])], link[active])
+
+    def _undershoot_event(atol):
+        def _event(t, z):
+            return np.min(_dep(z), initial=np.inf) + atol
+        _event.terminal = True
+        _event.direction = -1
+        return _event
+
+    def _expand(z):
+        z = np.asarray(z)
+        y_all = np.empty((initial_conc.size, z.shape[1]))
+        y_all[ind_idx] = z
+        y_all[dep_idx] = initial_conc[dep_idx, None] + \
+            np.dot(link, z - z0[:, None])
+        return y_all
+
+    _dydt.jac = _jac
+    _dydt.jac_sparsity = None
+    _dydt.network = dydt.network
+    _dydt.state_idx = ind_idx
+    _dydt.expand = _expand
+    _dydt.undershoot_event = _undershoot_event
+
+    return _dydt
@@ -0,0 +1,88 @@
+import numpy as np
+from scipy.constants import R, calorie, h, k, kilo
+from scipy.special import logsumexp
+
+
+def compile_es_layout(energy_profile_all, dgr_all, coeff_TS_all):
+    """Column layout of every catalytic cycle, for calc_es_tof (and
+    process_data_mkm_batch).
+
+    How process_data_mkm splits a reaction_data row into cycles only
+    depends on the columns. Its output for the row of column numbers
+    (1-based; 0 is the zero-energy reference the cycles start from) is
+    turned into gather indices here.
+
+    Returns
+    -------
+    layout : list of dict
+        per cycle: idx (columns of the intermediates/TS), coeff_TS and
+        dgr (column of the reaction energy)
+    """
+    return [{"idx": np.asarray(energy_profile, dtype=int),
+             "coeff_TS": np.asarray(coeff_TS, dtype=int),
+             "dgr": int(dgr)}
+            for energy_profile, dgr, coeff_TS in zip(
+                energy_profile_all, dgr_all, coeff_TS_all)]
+
+
+def _span_matrix(energy, dgr, coeff_TS):
+    """Effective barriers T_i - I_j (+ dgr if TS i comes before I_j).
+
+    The TS after each intermediate follows get_k: the next state if it is a
+    TS, otherwise the higher of the two intermediates (the reaction energy
+    for the last one). Leading axes of ``energy``/``dgr`` are batch axes.
+    """
+    inter = np.where(coeff_TS == 0)[0]
+    n_S = coeff_TS.size
+    I = energy[..., inter]
+    T = np.empty_like(I)
+    for a, p in enumerate(inter):
+        if p == n_S - 1:
+            T[..., a] = np.maximum(dgr, energy[..., p])
+        elif coeff_TS[p + 1] == 1:
+            T[..., a] = energy[..., p + 1]
+        else:
+            T[..., a] = np.maximum(energy[..., p + 1], energy[..., p])
+
+    before = np.arange(inter.size)[:, None] < np.arange(inter.size)
+    return T[..., :, None] - I[..., None, :] + \
+        np.where(before, dgr[..., None, None], 0)
+
+
+def calc_es_tof(profiles, layout, temperature):
+    """Energetic span and TOF of every cycle for a batch of profiles.
+
+    Uses the energetic span model of Kozuch and Shaik in the same form as
+    navicat_volcanic (AUTOF), TOF = kT/h / sum_ij exp(dE_ij/RT).
+
+    Parameters
+    ----------
+    profiles : (n_profile, n_tags) array
+        reaction_data rows (kcal/mol)
+    layout : list of dict
+        from compile_es_layout
+    temperature : float
+        in K
+
+    Returns
+    -------
+    log_tof : (n_profile, n_cycle) array
+        log10 TOF (s-1), NaN for profiles with missing energies
+    es : (n_profile, n_cycle) array
+        energetic span, max dE_ij (kcal/mol)
+    """
+    R_ = R * (1 / calorie) * (1 / kilo)
+    profiles = np.atleast_2d(np.asarray(profiles, dtype=np.float64))
+    energy_ext = np.concatenate(
+        [np.zeros((profiles.shape[0], 1)), profiles], axis=1)
+
+    log_tof = np.empty((profiles.shape[0], len(layout)))
+    es = np.empty_like(log_tof)
+    for c, cycle in enumerate(layout):
+        dE = _span_matrix(energy_ext[:, cycle["idx"]],
+                          energy_ext[:, cycle["dgr"]], cycle["coeff_TS"])
+        dE = dE.reshape(dE.shape[0], -1)
+        es[:, c] = np.max(dE, axis=1)
+        log_tof[:, c] = (np.log(k * temperature / h) -
+                         logsumexp(dE / (R_ * temperature), axis=1)) / np.log(10)
+    return log_tof, es
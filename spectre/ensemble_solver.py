@@ -0,0 +1,152 @@
+import time
+
+import numpy as np
+
+from rate_engine import calc_dydt, calc_jac, compile_rxn_network
+
+# Rosenbrock 2(3) pair of Shampine & Reichelt (MATLAB ode23s), L-stable
+D = 1 / (2 + np.sqrt(2))
+E32 = 6 + np.sqrt(2)
+
+
+def _batched_solve(W, b):
+    """Solve W[i] x[i] = b[i] for a stack, NaN rows where W[i] is singular."""
+    try:
+        return np.linalg.solve(W, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        x = np.full_like(b, np.nan)
+        for i in range(W.shape[0]):
+            try:
+                x[i] = np.linalg.solve(W[i], b[i])
+            except np.linalg.LinAlgError:
+                pass
+        return x
+
+
+def solve_ensemble(
+        k_forward_all,
+        k_reverse_all,
+        rxn_network_all,
+        initial_conc,
+        t_span,
+        rtol=1e-6,
+        atol=1e-9,
+        first_step=1e-14,
+        max_step=np.inf,
+        max_iter=100000,
+        timeout=None,
+        reactant_idx=None,
+        product_idx=None):
+    """Integrate many parameter sets of one network together, in lockstep.
+
+    Every member has its own time, step size and error control; each
+    iteration attempts one Rosenbrock step for all members still running,
+    with batched rate/Jacobian evaluation and batched linear solves.
+
+    Parameters
+    ----------
+    k_forward_all, k_reverse_all : array-like, (N, n_step)
+        Rate constants of the N members
+    rxn_network_all : array-like
+        Reaction network matrix shared by all members
+    initial_conc : array-like, (n_species,) or (N, n_species)
+    t_span : tuple
+    rtol, atol : float
+    first_step, max_step : float
+    max_iter : int
+        Maximum number of lockstep iterations
+    timeout : float, optional
+        Wall-clock limit (s); members still running are marked as failed
+    reactant_idx, product_idx : array-like, optional
+        With product_idx, members stop once the reaction has finished, by
+        the criterion of kinetic_solver.finished_event on the last step;
+        their final state is the plateau
+
+    Returns
+    -------
+    y_final : (N, n_species) array
+        Concentrations at t_span[1], NaN for failed members
+    status : (N,) int array
+        0 if the member reached t_span[1] (or finished), -1 if it failed
+    info : dict
+        n_iter (lockstep iterations), nfev and njev (per-member evaluations)
+    """
+    k_forward_all = np.atleast_2d(np.asarray(k_forward_all, dtype=np.float64))
+    k_reverse_all = np.atleast_2d(np.asarray(k_reverse_all, dtype=np.float64))
+    network = compile_rxn_network(rxn_network_all)
+    n_member = k_forward_all.shape[0]
+    n_species = network["n_species"]
+    t0, t1 = t_span
+
+    reactant_idx = np.asarray(
+        [] if reactant_idx is None else reactant_idx, dtype=int)
+    y = np.array(np.broadcast_to(initial_conc, (n_member, n_species)),
+                 dtype=np.float64)
+    t = np.full(n_member, float(t0))
+    h = np.full(n_member, float(first_step))
+    status = np.ones(n_member, dtype=int)  # 1 running, 0 done, -1 failed
+    f = calc_dydt(y, k_forward_all, k_reverse_all, network)
+    identity = np.eye(n_species)
+    nfev = n_member
+    njev = 0
+    n_iter = 0
+    start = time.time()
+
+    while np.any(status == 1):
+        if n_iter >= max_iter or (
+                timeout is not None and time.time() - start > timeout):
+            status[status == 1] = -1
+            break
+        n_iter += 1
+
+        a = np.where(status == 1)[0]
+        kf = k_forward_all[a]
+        kr = k_reverse_all[a]
+        ya = y[a]
+        f0 = f[a]
+        to_end = t1 - t[a]
+        ha = np.minimum(h[a], to_end)
+        hc = ha[:, None]
+
+        J = calc_jac(ya, kf, kr, network)
+        W = identity - (D * ha)[:, None, None] * J
+        k1 = _batched_solve(W, f0)
+        f1 = calc_dydt(ya + 0.5 * hc * k1, kf, kr, network)
+        k2 = _batched_solve(W, f1 - k1) + k1
+        y_new = ya + hc * k2
+        f2 = calc_dydt(y_new, kf, kr, network)
+        k3 = _batched_solve(W, f2 - E32 * (k2 - f1) - 2 * (k1 - f0))
+        nfev += 2 * a.size
+        njev += a.size
+
+        err = hc / 6 * (k1 - 2 * k2 + k3)
+        scale = atol + rtol * np.maximum(np.abs(ya), np.abs(y_new))
+        with np.errstate(invalid="ignore", over="ignore"):
+            err_norm = np.sqrt(np.mean((err / scale) ** 2, axis=1))
+        finite = np.isfinite(err_norm) & np.all(np.isfinite(y_new), axis=1)
+        accept = finite & (err_norm <= 1)
+
+        acc = a[accept]
+        y[acc] = y_new[accept]
+        f[acc] = f2[accept]
+        t[acc] = np.where(ha[accept] >= to_end[accept], t1, t[acc] + ha[accept])
+        status[acc[t[acc] >= t1]] = 0
+        if product_idx is not None:
+            rate = np.abs(y_new - ya) / hc
+            slack = rate * (t1 - t[a])[:, None] - atol - rtol * np.abs(y_new)
+            consumed = np.any(y_new[:, reactant_idx] <= atol, axis=1)
+            done = np.where(consumed, np.all(slack[:, product_idx] < 0, axis=1),
+                            np.all(slack < 0, axis=1))
+            status[acc[done[accept]]] = 0
+
+        with np.errstate(divide="ignore"):
+            factor = np.where(
+                finite, np.clip(0.9 * err_norm ** (-1 / 3), 0.2, 5), 0.2)
+        h[a] = np.minimum(ha * factor, max_step)
+
+        # steps below the spacing of floats at t cannot make progress
+        stuck = h[a] <= 10 * np.spacing(np.maximum(np.abs(t[a]), 1e-300))
+        status[a[stuck & (status[a] == 1)]] = -1
+
+    y[status != 0] = np.nan
+    return y, status, {"n_iter": n_iter, "nfev": nfev, "njev": njev}
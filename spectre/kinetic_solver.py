@@ -3,13 +3,20 @@
 import argparse
 import warnings
 
-import autograd.numpy as np
+import numpy as np
 import pandas as pd
-from autograd import jacobian
 from scipy.constants import R, calorie, h, k, kilo
 from scipy.integrate import solve_ivp
+from scipy.sparse import csc_matrix
 
+from conservation import conservation_system
+from linear_kinetics import linear_network, linear_ok, solve_linear, time_grid
+from network_codegen import load_kernels
 from plot_function import plot_evo_save
+from qssa import qssa_system
+from rate_engine import (SPARSE_JAC_MIN_SPECIES, calc_dydt, calc_jac,
+                         calc_jac_sparse, compile_rxn_network,
+                         compile_sparse_jac)
 
 warnings.filterwarnings("ignore")
 
@@ -275,36 +282,169 @@ def calc_k(
     return k_forward_all, k_reverse_all
 
 
-def add_rate(
-        y,
-        k_forward_all,
-        k_reverse_all,
-        rxn_network_all,
-        a):
+_DG_TEMPLATES = {}
 
-    rate = 0
-    left_species = np.where(rxn_network_all[a, :] < 0)
-    right_species = np.where(rxn_network_all[a, :] > 0)
-    rate += k_forward_all[a] * np.prod(y[left_species]
-                                       ** np.abs(rxn_network_all[a, left_species])[0])
-    rate -= k_reverse_all[a] * np.prod(y[right_species]
-                                       ** np.abs(rxn_network_all[a, right_species])[0])
 
-    return rate
+def dG_ddag_template(coeff_TS):
+    """Where get_dG_ddag takes I and T from, for a profile with dgr appended.
 
+    Returns (i_idx, t_idx, t_max): for every intermediate, its position and
+    the position of the next state (n_S stands for dgr); with t_max the
+    barrier top is the higher of the two, as for a TS-less step. Cached per
+    TS pattern.
+    """
+    key = tuple(int(c) for c in coeff_TS)
+    if key not in _DG_TEMPLATES:
+        coeff_TS = np.asarray(key)
+        n_S = coeff_TS.size
+        i_idx = np.where(coeff_TS == 0)[0]
+        t_idx = i_idx + 1
+        t_max = np.ones(i_idx.size, dtype=bool)
+        t_max[t_idx < n_S] = coeff_TS[t_idx[t_idx < n_S]] == 0
+        _DG_TEMPLATES[key] = (i_idx, t_idx, t_max)
+    return _DG_TEMPLATES[key]
+
+
+def _dG_ddag_batch(energy_profile, dgr, coeff_TS):
+    # get_dG_ddag for (n_profile, n_S) energies at once
+    i_idx, t_idx, t_max = dG_ddag_template(coeff_TS)
+    energy_ext = np.column_stack([energy_profile, dgr])
+    I = energy_ext[:, i_idx]
+    T = energy_ext[:, t_idx]
+    T = np.where(t_max & ~(T > I), I, T)
+    return T.astype(np.float64) - I.astype(np.float64)
+
+
+def calc_k_batch(
+        energy_profile_all,
+        dgr_all,
+        coeff_TS_all,
+        temperature):
+    """calc_k for a batch of profiles and temperatures in one pass.
 
-def calc_dX_dt(y, k_forward_all, k_reverse_all, rxn_network_all, a):
-
-    loc_idxs = np.where(rxn_network_all[:, a] != 0)[0]
-    all_rate = [np.sign(rxn_network_all[idx,
-                                        a]) * add_rate(y,
-                                                       k_forward_all,
-                                                       k_reverse_all,
-                                                       rxn_network_all,
-                                                       idx) for idx in loc_idxs]
-    dX_dt = np.sum(all_rate)
+    Parameters
+    ----------
+    energy_profile_all : list of (n_profile, n_S) arrays
+        the energy profile of every cycle, one row per profile
+    dgr_all : list of (n_profile,) arrays
+    coeff_TS_all : list of one-hot arrays
+        TS pattern of every cycle, shared by the batch
+    temperature : float or (n_T,) array
 
-    return dX_dt
+    Returns
+    -------
+    k_forward_all, k_reverse_all : (n_profile, n_step) arrays, or
+        (n_profile, n_T, n_step) for an array of temperatures; identical to
+        calc_k for every profile and temperature
+    """
+    dG_forward, dG_reverse = [], []
+    for energy_profile, dgr, coeff_TS in zip(
+            energy_profile_all, dgr_all, coeff_TS_all):
+        energy_profile = np.atleast_2d(energy_profile)
+        dgr = np.broadcast_to(dgr, energy_profile.shape[:1])
+        coeff_TS = np.asarray(coeff_TS)
+        dG_forward.append(_dG_ddag_batch(energy_profile, dgr, coeff_TS))
+
+        coeff_TS_reverse = np.insert(coeff_TS[::-1], 0, 0)[:-1]
+        energy_profile_reverse = np.column_stack([
+            np.zeros(energy_profile.shape[0], dtype=energy_profile.dtype),
+            energy_profile[:, ::-1][:, :-1] - dgr[:, None]])
+        dG_reverse.append(_dG_ddag_batch(
+            energy_profile_reverse, -dgr, coeff_TS_reverse)[:, ::-1])
+
+    dG_forward = np.concatenate(dG_forward, axis=1)
+    dG_reverse = np.concatenate(dG_reverse, axis=1)
+    if np.ndim(temperature) > 0:
+        temperature = np.asarray(temperature, dtype=np.float64)[:, None]
+        dG_forward = dG_forward[:, None, :]
+        dG_reverse = dG_reverse[:, None, :]
+    return erying(dG_forward, temperature), erying(dG_reverse, temperature)
+
+
+def project_non_negative(result_solve_ivp, tolerance):
+    """Check a solve_ivp result and project its trajectory onto y >= 0.
+
+    Mass-action kinetics cannot drive a concentration below zero, so negative
+    values are integration error. Undershoots are clipped in place; a failed
+    integration, or a final state more than ``tolerance`` below zero, raises
+    ValueError so that the caller can retry with tighter settings.
+    """
+    if not result_solve_ivp.success:
+        raise ValueError(result_solve_ivp.message)
+    if np.min(result_solve_ivp.y[:, -1]) < -tolerance:
+        raise ValueError("negative concentrations beyond tolerance")
+    np.maximum(result_solve_ivp.y, 0, out=result_solve_ivp.y)
+    return result_solve_ivp
+
+
+def finished_event(dydt, states, t_end, rtol, atol):
+    """Terminal solve_ivp event for a reaction that has finished.
+
+    After every accepted step, the change over that step is extrapolated to
+    the rest of t_span. The reaction has finished once no species could then
+    change by more than atol + rtol * y, the error the integrator allows.
+    Once a reactant is used up (below atol), only the products are watched.
+    A flat product alone is not enough, since it is also flat during an
+    induction period.
+
+    The event is a step function (+1, then -1 from the step where the
+    reaction finished), so the root finding of solve_ivp only locates that
+    step. Derivatives at interpolated states would be too noisy for it: they
+    carry the fast modes of the catalyst states. ``dydt`` is any right-hand
+    side of system_KE_DE (full, QSSA or conservation-reduced).
+    """
+    state_idx = getattr(dydt, "state_idx", np.arange(len(states)))
+    R_idx = [i for i, s in enumerate(
+        states) if s.lower().startswith('r') and 'INT' not in s]
+    P_idx = [i for i, s in enumerate(
+        states) if s.lower().startswith('p') and 'INT' not in s]
+    R_pos = np.where(np.isin(state_idx, R_idx))[0]
+    P_pos = np.where(np.isin(state_idx, P_idx))[0]
+    last = {"t": None, "y": None, "t_done": np.inf}
+
+    def _event(t, y):
+        # solve_ivp calls this at t0 and after every step, in increasing t;
+        # calls at earlier t come from the root finding
+        if last["t"] is None or (t > last["t"] and t < last["t_done"]):
+            if last["t"] is not None:
+                rate = np.abs(y - last["y"]) / (t - last["t"])
+                slack = rate * (t_end - t) - atol - rtol * np.abs(y)
+                if np.any(y[R_pos] <= atol):
+                    slack = slack[P_pos]
+                if np.all(slack < 0):
+                    last["t_done"] = t
+            last["t"], last["y"] = t, np.array(y)
+        return -1.0 if t >= last["t_done"] else 1.0
+
+    _event.terminal = True
+    _event.direction = -1
+    return _event
+
+
+def hold_plateau(result_solve_ivp, t_end, t_eval=None):
+    """Extend a solution stopped by finished_event to t_end (in place).
+
+    The state where the reaction finished is reported as the plateau: it is
+    repeated at the remaining t_eval samples, or at t_end, so that the time
+    axis covers t_span as for a full run.
+    """
+    if result_solve_ivp.status != 1:
+        return result_solve_ivp
+    t_stop = result_solve_ivp.t_events[0][-1]
+    y_stop = result_solve_ivp.y_events[0][-1]
+    # solve_ivp leaves empty lists if no t_eval sample was reached
+    t = np.asarray(result_solve_ivp.t, dtype=np.float64)
+    y = np.asarray(result_solve_ivp.y, dtype=np.float64).reshape(
+        y_stop.size, t.size)
+    if t_eval is None:
+        t_hold = np.array([t_end]) if t_stop < t_end else np.array([])
+    else:
+        t_eval = np.asarray(t_eval, dtype=np.float64)
+        t_hold = t_eval[t_eval > t_stop]
+    result_solve_ivp.t = np.append(t, t_hold)
+    result_solve_ivp.y = np.concatenate(
+        [y, np.repeat(y_stop[:, None], t_hold.size, axis=1)], axis=1)
+    return result_solve_ivp
 
 
 def system_KE_DE(
@@ -312,66 +452,64 @@ def system_KE_DE(
         k_reverse_all,
         rxn_network_all,
         initial_conc,
-        states):
+        states,
+        sparse=None,
+        codegen=False,
+        qssa=False,
+        conserve=False):
+
+    network = compile_rxn_network(rxn_network_all)
+    if qssa:
+        # catalyst states in quasi-steady state, only R/P are integrated
+        return qssa_system(k_forward_all, k_reverse_all, network, states,
+                           initial_conc)
+
+    if sparse is None:
+        sparse = network["n_species"] >= SPARSE_JAC_MIN_SPECIES
+
+    if codegen:
+        # straight-line kernels generated (and cached) per network topology
+        kernels = load_kernels(rxn_network_all, states)
+        n = network["n_species"]
+
+        def _rhs(y):
+            return kernels.dydt(y, k_forward_all, k_reverse_all)
+
+        if sparse:
+            def _jac(t, y):
+                return csc_matrix(
+                    (kernels.jac_data(y, k_forward_all, k_reverse_all),
+                     kernels.JAC_INDICES, kernels.JAC_INDPTR), shape=(n, n))
+        else:
+            def _jac(t, y):
+                return kernels.jac(y, k_forward_all, k_reverse_all)
+    else:
+        def _rhs(y):
+            return calc_dydt(y, k_forward_all, k_reverse_all, network)
 
-    boundary = np.zeros((initial_conc.shape[0], 2))
-    tolerance = 1
-    R_idx = [i for i, s in enumerate(
-        states) if s.lower().startswith('r') and 'INT' not in s]
-    P_idx = [i for i, s in enumerate(
-        states) if s.lower().startswith('p') and 'INT' not in s]
-    INT_idx = [i for i in range(1, initial_conc.shape[0])
-               if i not in R_idx and i not in P_idx]
-
-    boundary[0] = [0 - tolerance, initial_conc[0] + tolerance]
-    for i in R_idx:
-        boundary[i] = [0 - tolerance, initial_conc[i] + tolerance]
-    for i in P_idx:
-        boundary[i] = [0 - tolerance, np.max(initial_conc[R_idx]) + tolerance]
-    for i in INT_idx:
-        boundary[i] = [0 - tolerance, initial_conc[0] + tolerance]
-
-    def bound_decorator(boundary):
-        def decorator(func):
-            def wrapper(t, y):
-                dy_dt = func(t, y)
-                violate_low_idx = np.where(y < boundary[:, 0])
-                violate_up_idx = np.where(y > boundary[:, 1])
-                if violate_up_idx[0] and violate_low_idx[0]:
-                    try:
-                        y[violate_low_idx] = boundary[violate_low_idx, 0]
-                        y[violate_up_idx] = boundary[violate_up_idx, 1]
-                        # dy_dt[violate_low_idx] = dy_dt[violate_low_idx] + (boundary[violate_low_idx, 0] - y[violate_low_idx])/2
-                        # dy_dt[violate_up_idx] = dy_dt[violate_up_idx] + (boundary[violate_up_idx, 1] - y[violate_up_idx])/2
-                        dy_dt[violate_low_idx] = 0
-                        dy_dt[violate_up_idx] = 0
-                    except TypeError as e:
-                        y_ = np.array(y._value)
-                        dy_dt_ = np.array(dy_dt._value)
-                        # arraybox failure
-                        y_[violate_low_idx] = boundary[violate_low_idx, 0]
-                        y_[violate_up_idx] = boundary[violate_up_idx, 1]
-                        # dy_dt[violate_low_idx] = dy_dt[violate_low_idx] + (boundary[violate_low_idx, 0] - y[violate_low_idx])/2
-                        # dy_dt[violate_up_idx] = dy_dt[violate_up_idx] + (boundary[violate_up_idx, 1] - y[violate_up_idx])/2
-                        dy_dt_[violate_low_idx] = 0
-                        dy_dt_[violate_up_idx] = 0
-                        dy_dt = np.array(dy_dt_)
-                        y = np.array(y_)
-                return dy_dt
-            return wrapper
-        return decorator
-
-    @bound_decorator(boundary)
+        if sparse:
+            compile_sparse_jac(network)
+
+            def _jac(t, y):
+                return calc_jac_sparse(
+                    y, k_forward_all, k_reverse_all, network)
+        else:
+            def _jac(t, y):
+                return calc_jac(y, k_forward_all, k_reverse_all, network)
+
+    # the bare mass-action RHS is smooth, which is what the BDF/Radau error
+    # control and Newton iterations rely on; non-negativity is enforced on the
+    # accepted solution instead (see project_non_negative)
     def _dydt(t, y):
-        dydt = [None for _ in range(initial_conc.shape[0])]
-        for a in range(initial_conc.shape[0]):
-            dydt[a] = calc_dX_dt(
-                y, k_forward_all, k_reverse_all, rxn_network_all, a)
-        dydt = np.array(dydt)
-        return dydt
+        return _rhs(y)
 
-    _dydt.jac = jacobian(_dydt, argnum=1)
+    _dydt.jac = _jac
+    _dydt.jac_sparsity = network["sparsity"]
+    _dydt.network = network
 
+    if conserve:
+        # integrate the independent species only
+        return conservation_system(_dydt, states, initial_conc)
     return _dydt
 
 
@@ -451,11 +589,46 @@ if __name__ == "__main__":
         default="ls",
         help="time scale (ls (log10(s)), s, lmin, min, h, day) (default=ls)",
     )
+    parser.add_argument(
+        "-cg",
+        "--codegen",
+        dest="codegen",
+        action="store_true",
+        help="""Toggle to use rate/Jacobian kernels generated for this network (cached on disk, JIT-compiled if numba is installed). (default: False)""",
+    )
+
+    parser.add_argument(
+        "-lin",
+        "--linear",
+        dest="linear",
+        action="store_true",
+        help="""Toggle to hold reactants/products at their initial concentrations (large excess) and solve the then linear kinetics in closed form; falls back to the integrator if they change by more than 5%%. Linear networks always use the closed form. (default: False)""",
+    )
+
+    parser.add_argument(
+        "-te",
+        "--t_eval",
+        dest="t_eval",
+        type=float,
+        nargs='+',
+        help="Times (s) at which to store the concentrations, instead of every integration step (the final time is always included)",
+    )
+    parser.add_argument(
+        "-fo",
+        "--final_only",
+        dest="final_only",
+        action="store_true",
+        help="""Toggle to store only the final state (and the -te samples) without dense output; no evolution plot is made. (default: False)""",
+    )
 
     args = parser.parse_args()
     more_species_mkm = args.addition
+    linear = args.linear
+    t_eval = args.t_eval
+    final_only = args.final_only
     w_dir = args.dir
     x_scale = args.xscale
+    codegen = args.codegen
     if w_dir:
         args = parser.parse_args(['-i', f"{w_dir}/reaction_data.csv",
                                   '-c', f"{w_dir}/c0.txt",
@@ -473,8 +646,28 @@ if __name__ == "__main__":
     assert k_forward_all.shape[0] == rxn_network_all.shape[0]
     assert k_reverse_all.shape[0] == rxn_network_all.shape[0]
 
+    if final_only or t_eval is not None:
+        t_eval = np.union1d([] if t_eval is None else t_eval, [t_span[1]])
+
+    network = linear_network(rxn_network_all, states)
+    if network is None and linear:
+        network = linear_network(rxn_network_all, states, True)
+    result_solve_ivp = None
+    if network is not None:
+        result_solve_ivp = solve_linear(
+            k_forward_all, k_reverse_all, network, initial_conc,
+            time_grid(t_span) if t_eval is None else t_eval)
+        if linear_ok(result_solve_ivp.y, network, initial_conc):
+            print("Kinetics solved in closed form")
+        else:
+            print("Closed form not accepted, integrating instead")
+            result_solve_ivp = None
+    elif linear:
+        print("The network is not pseudo-first-order, integrating instead")
+
     dydt = system_KE_DE(k_forward_all, k_reverse_all,
-                        rxn_network_all, initial_conc, states)
+                        rxn_network_all, initial_conc, states,
+                        codegen=codegen)
 
     max_step = (t_span[1] - t_span[0]) / 1
     first_step = np.min(
@@ -494,26 +687,35 @@ if __name__ == "__main__":
     jac = dydt.jac
     eps = 1e-7  # to avoid crashing due to dividing with zeroes
 
-    result_solve_ivp = solve_ivp(
-        dydt,
-        t_span,
-        initial_conc + eps,
-        method=method,
-        dense_output=True,
-        first_step=first_step,
-        max_step=max_step,
-        rtol=rtol,
-        atol=atol,
-        jac=jac,
-    )
-    states_ = [s.replace("*", "") for s in states]
-    plot_evo_save(
-        result_solve_ivp,
-        w_dir,
-        "",
-        states_,
-        x_scale,
-        more_species_mkm)
+    if result_solve_ivp is None:
+        result_solve_ivp = solve_ivp(
+            dydt,
+            t_span,
+            initial_conc + eps,
+            method=method,
+            dense_output=not final_only,
+            t_eval=t_eval,
+            first_step=first_step,
+            max_step=max_step,
+            rtol=rtol,
+            atol=atol,
+            jac=jac,
+        )
+    try:
+        project_non_negative(result_solve_ivp, rtol * np.max(initial_conc))
+    except ValueError as e:
+        print(f"\nThe kinetics could not be solved: {e}")
+        print("Try another integration method (-de) or reaction time (-Tf)")
+        raise SystemExit(1)
+    if not final_only:
+        states_ = [s.replace("*", "") for s in states]
+        plot_evo_save(
+            result_solve_ivp,
+            w_dir,
+            "",
+            states_,
+            x_scale,
+            more_species_mkm)
 
     print("\n-------------Reactant Initial Concentration-------------\n")
     r_indices = [i for i, s in enumerate(states) if s.lower().startswith("r")]
@@ -10,13 +10,12 @@ import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import sklearn as sk
 from joblib import Parallel, delayed
 from navicat_volcanic.dv1 import curate_d, find_1_dv
 from navicat_volcanic.dv2 import find_2_dv
 from navicat_volcanic.helpers import (bround, group_data_points,
                                       user_choose_1_dv, user_choose_2_dv)
-from navicat_volcanic.plotting2d import calc_ci, plot_2d, plot_2d_lsfer
+from navicat_volcanic.plotting2d import plot_2d, plot_2d_lsfer
 from navicat_volcanic.plotting3d import (bround, get_bases, plot_3d_contour,
                                          plot_3d_contour_regions,
                                          plot_3d_lsfer, plot_3d_scatter)
@@ -26,8 +25,19 @@ from sklearn.experimental import enable_iterative_imputer
 from sklearn.impute import IterativeImputer, KNNImputer, SimpleImputer
 from tqdm import tqdm
 
-from kinetic_solver import calc_k, system_KE_DE
+from checkpoint import Checkpoint, checkpoint_key
+from energetic_span import calc_es_tof, compile_es_layout
+from ensemble_solver import solve_ensemble
+from kinetic_solver import (calc_k, calc_k_batch, finished_event,
+                            hold_plateau, project_non_negative, system_KE_DE)
+from lfesr import (fit_lfesr, lfesr_ci, load_regression, predict_lfesr,
+                   regression_key, save_regression)
+from linear_kinetics import linear_network, linear_ok, solve_linear, time_grid
 from plot_function import plot_2d_combo, plot_3d_, plot_evo
+from qssa import compile_qssa
+from result_cache import get_result_cache, result_cache_path, result_key
+from rate_engine import compile_rxn_network
+from worker_pool import SharedArray, nearest_cost, run_pool, shared_folder
 
 
 def check_km_inp(df, df_network):
@@ -83,7 +93,7 @@ def check_km_inp(df, df_network):
     return clear
 
 
-def process_data_mkm(dg, df_network, c0, tags):
+def _process_data_mkm(dg, df_network, c0, tags):
 
     df_network.fillna(0, inplace=True)
 
@@ -166,6 +176,70 @@ def process_data_mkm(dg, df_network, c0, tags):
         coeff_TS_all, rxn_network_all
 
 
+_PROFILES = {}
+
+
+def compile_profile(df_network, c0, tags):
+    """What process_data_mkm derives from the network, c0 and tags.
+
+    The split of a reaction_data row into cycles, the network and the
+    initial concentrations do not depend on the energies, so they are worked
+    out once (with pandas) and cached per input.
+
+    Returns
+    -------
+    profile : dict
+        initial_conc, rxn_network_all and layout (compile_es_layout of the
+        cycles, the gather indices for process_data_mkm_batch)
+    """
+    key = (tuple(tags), str(c0), tuple(df_network.index),
+           tuple(df_network.columns), df_network.to_numpy().tobytes())
+    if key not in _PROFILES:
+        initial_conc, energy_profile_all, dgr_all, \
+            coeff_TS_all, rxn_network_all = _process_data_mkm(
+                np.arange(1, len(tags) + 1), df_network, c0, tags)
+        _PROFILES[key] = {
+            "initial_conc": initial_conc,
+            "rxn_network_all": rxn_network_all,
+            "layout": compile_es_layout(
+                energy_profile_all, dgr_all, coeff_TS_all)}
+    return _PROFILES[key]
+
+
+def process_data_mkm(dg, df_network, c0, tags):
+    """Split a reaction_data row into its cycles for the MKM.
+
+    Returns (initial_conc, energy_profile_all, dgr_all, coeff_TS_all,
+    rxn_network_all); the row is gathered with the cached compile_profile.
+    """
+    profile = compile_profile(df_network, c0, tags)
+    energy_profile_all, dgr_all, coeff_TS_all = process_data_mkm_batch(
+        dg, profile["layout"])
+    return profile["initial_conc"].copy(), \
+        [energy_profile[0] for energy_profile in energy_profile_all], \
+        [dgr[0] for dgr in dgr_all], \
+        [coeff_TS.copy() for coeff_TS in coeff_TS_all], \
+        profile["rxn_network_all"].copy()
+
+
+def process_data_mkm_batch(profiles, layout):
+    """Cycles of many reaction_data rows at once, as process_data_mkm.
+
+    ``layout`` is the one of compile_profile. The cycles keep the dtypes process_data_mkm gives them (the
+    first is upcast by its zero reference). Returns (energy_profile_all,
+    dgr_all, coeff_TS_all) with a leading profile axis, for calc_k_batch.
+    """
+    profiles = np.atleast_2d(np.asarray(profiles))
+    energy_ext = np.column_stack(
+        [np.zeros(profiles.shape[0], dtype=profiles.dtype), profiles])
+    energy_profile_all, dgr_all = [], []
+    for cycle in layout:
+        dtype = np.float64 if 0 in cycle["idx"] else profiles.dtype
+        energy_profile_all.append(energy_ext[:, cycle["idx"]].astype(dtype))
+        dgr_all.append(energy_ext[:, cycle["dgr"]].astype(dtype))
+    return energy_profile_all, dgr_all, [cycle["coeff_TS"] for cycle in layout]
+
+
 def calc_km(
         energy_profile_all: list,
         dgr_all: list,
@@ -177,7 +251,73 @@ def calc_km(
         states: list,
         timeout: float,
         report_as_yield: bool,
-        quality: int = 0,):
+        quality: int = 0,
+        codegen: bool = False,
+        qssa: bool = False,
+        conserve: bool = False,
+        linear: bool = False,
+        final_only: bool = False,
+        t_eval=None,
+        warm: dict = None,
+        cache: str = None):
+    """MKM of one energy profile.
+
+    With ``final_only`` no dense interpolant is built and ``result_solve_ivp``
+    only holds the final state, plus the ``t_eval`` samples if given; this is
+    all volcano and map runs need. ``t_eval`` always gets t_span[1] added.
+
+    ``warm`` is a dict shared by consecutive calls for neighbouring profiles.
+    Each call records the solver attempt that succeeded (method and
+    tolerance rung) and its first accepted step. The next call starts from
+    that attempt (one cheaper if it needed no retry), and from that step if
+    quality leaves it free.
+
+    ``cache`` is the path of a ResultCache. With ``final_only`` (and no
+    ``t_eval``) the result is looked up there first and stored there once
+    solved; a cached result comes with result_solve_ivp None. Failed (NaN)
+    solves are not cached.
+    Returns (c_target, result_solve_ivp).
+    """
+    key = None
+    if cache is not None and final_only and t_eval is None:
+        key = result_key(
+            rxn_network_all, states, energy_profile_all, dgr_all,
+            coeff_TS_all, (temperature, t_span, initial_conc, timeout,
+                           report_as_yield, quality, qssa, conserve, linear))
+        c_target = get_result_cache(cache).get(key)
+        if c_target is not None:
+            return c_target, None
+
+    c_target, result_solve_ivp = _calc_km(
+        energy_profile_all, dgr_all, temperature, coeff_TS_all,
+        rxn_network_all, t_span, initial_conc, states, timeout,
+        report_as_yield, quality, codegen, qssa, conserve, linear,
+        final_only, t_eval, warm)
+    if key is not None and not np.any(np.isnan(c_target)):
+        get_result_cache(cache).put(key, c_target)
+    return c_target, result_solve_ivp
+
+
+def _calc_km(
+        energy_profile_all: list,
+        dgr_all: list,
+        temperature: float,
+        coeff_TS_all: list,
+        rxn_network_all: np.ndarray,
+        t_span: tuple,
+        initial_conc: np.ndarray,
+        states: list,
+        timeout: float,
+        report_as_yield: bool,
+        quality: int = 0,
+        codegen: bool = False,
+        qssa: bool = False,
+        conserve: bool = False,
+        linear: bool = False,
+        final_only: bool = False,
+        t_eval=None,
+        warm: dict = None):
+    """calc_km, without the result cache."""
 
     idx_target_all = [states.index(i) for i in states if "*" in i]
     k_forward_all, k_reverse_all = calc_k(
@@ -186,17 +326,65 @@ def calc_km(
         coeff_TS_all,
         temperature)
 
-    dydt = system_KE_DE(k_forward_all, k_reverse_all,
-                        rxn_network_all, initial_conc, states)
+    if final_only or t_eval is not None:
+        t_eval = np.union1d([] if t_eval is None else t_eval, [t_span[1]])
+    if conserve and warm is not None and warm.get("full"):
+        # the previous profile needed the full system
+        conserve = False
+    dense_output = not final_only
+
+    # linear (or, with linear, pseudo-first-order) kinetics in closed form
+    result = calc_km_linear(
+        k_forward_all, k_reverse_all, rxn_network_all, t_span,
+        initial_conc, states, report_as_yield, pseudo_first_order=linear,
+        t_eval=t_eval)
+    if result is not None:
+        return result
+
+    if qssa:
+        result = calc_km_qssa(
+            k_forward_all, k_reverse_all, rxn_network_all, t_span,
+            initial_conc, states, timeout, report_as_yield, quality,
+            t_eval=t_eval)
+        if result is not None:
+            return result
+        # the reduced model failed, fall back to the full one
 
-    # first try BDF + ag with various rtol and atol
-    # then BDF with FD as arraybox failure tends to happen when R/P loc is complicate
+    dydt = system_KE_DE(k_forward_all, k_reverse_all,
+                        rxn_network_all, initial_conc, states,
+                        codegen=codegen, conserve=conserve)
+    # the conservation-reduced system integrates a subset of the species
+    y0 = initial_conc[dydt.state_idx] if conserve else initial_conc
+
+    def _accept(result_solve_ivp, tolerance):
+        hold_plateau(result_solve_ivp, t_span[1], t_eval)
+        # the rebuilt dependent species are not error-controlled, check them too
+        if conserve:
+            result_solve_ivp.y = dydt.expand(result_solve_ivp.y)
+        project_non_negative(result_solve_ivp, tolerance)
+
+    def _finished(rtol, atol):
+        # stop once the products have plateaued within the tolerances
+        return finished_event(dydt, states, t_span[1], rtol, atol)
+
+    def _first_accepted():
+        # never fires, records the first accepted step for warm starts
+        def _event(t, y):
+            if _event.t0 is None:
+                _event.t0 = t
+            elif _event.h is None:
+                _event.h = t - _event.t0
+            return 1.0
+        _event.t0 = _event.h = None
+        return _event
+
+    # first try BDF + analytic jacobian with various rtol and atol
+    # then BDF with FD in case the analytic jacobian run still fails
     # then LSODA + FD if all BDF attempts fail
     # the last resort is a Radau
     # if all fail, return NaN
     rtol_values = [1e-3, 1e-6, 1e-9]
     atol_values = [1e-6, 1e-9, 1e-9]
-    last_ = [rtol_values[-1], atol_values[-1]]
 
     if quality == 0:
         max_step = np.nan
@@ -228,7 +416,6 @@ def calc_km(
         )
         rtol_values = [1e-6, 1e-9, 1e-10]
         atol_values = [1e-9, 1e-9, 1e-10]
-        last_ = [rtol_values[-1], atol_values[-1]]
     elif quality > 2:
         max_step = (t_span[1] - t_span[0]) / 50.0
         first_step = np.min(
@@ -244,144 +431,281 @@ def calc_km(
         )
         rtol_values = [1e-6, 1e-9, 1e-10]
         atol_values = [1e-9, 1e-9, 1e-10]
-        last_ = [rtol_values[-1], atol_values[-1]]
-    success = False
-    cont = False
-
-    while success == False:
-        atol = atol_values.pop(0)
-        rtol = rtol_values.pop(0)
+    attempts = [dict(method="BDF", rtol=rtol, atol=atol, jac=dydt.jac)
+                for rtol, atol in zip(rtol_values, atol_values)]
+    attempts += [dict(method="BDF", rtol=rtol, atol=atol,
+                      jac_sparsity=dydt.jac_sparsity)
+                 for rtol, atol in zip([1e-6, 1e-9, 1e-10], [1e-9, 1e-9, 1e-10])]
+    attempts += [dict(method="LSODA", rtol=1e-6, atol=1e-9),
+                 dict(method="Radau", rtol=1e-6, atol=1e-9, jac=dydt.jac)]
+    n_first = len(rtol_values)
+
+    # a warm start skips the attempts that failed for the previous profile
+    # and begins with the step it first took, at any quality
+    start = 0
+    if warm is not None:
+        start = warm.get("attempt", 0)
+        if warm.get("first_step"):
+            first_step = warm["first_step"]
+            if np.isfinite(max_step):
+                first_step = min(first_step, max_step)
+
+    result_solve_ivp = "Shiki"
+    undershoot = False
+    for n in range(start, len(attempts)):
+        if conserve and (n == n_first or undershoot):
+            # the reduced system failed, or rebuilt a species below zero,
+            # the full one gets the whole ladder
+            if warm is not None:
+                warm["full"] = True
+                warm["attempt"] = 0
+            return _calc_km(
+                energy_profile_all, dgr_all, temperature, coeff_TS_all,
+                rxn_network_all, t_span, initial_conc, states, timeout,
+                report_as_yield, quality, codegen, final_only=final_only,
+                t_eval=t_eval, warm=warm)
+
+        attempt = dict(attempts[n])
+        method = attempt.pop("method")
+        rtol = attempt.pop("rtol")
+        atol = attempt.pop("atol")
+        if method == "BDF":
+            tolerance = rtol * np.max(initial_conc)
+        elif method == "LSODA":
+            tolerance = 1e-6 * np.max(initial_conc)
+        else:
+            tolerance = np.inf
+        first_accepted = _first_accepted()
+        events = [_finished(rtol, atol), first_accepted]
+        if conserve:
+            events.append(dydt.undershoot_event(atol))
         try:
-            result_solve_ivp = solve_ivp(
+            result = solve_ivp(
                 dydt,
                 t_span,
-                initial_conc,
-                method="BDF",
-                dense_output=True,
+                y0,
+                method=method,
+                dense_output=dense_output,
+                t_eval=t_eval,
                 rtol=rtol,
                 atol=atol,
-                jac=dydt.jac,
                 max_step=max_step,
                 first_step=first_step,
-                timeout=timeout,
+                events=events,
+                timeout=timeout + 10 if method == "Radau" else timeout,
+                **attempt,
             )
-            # timeout
-            if result_solve_ivp == "Shiki":
-                if rtol == last_[0] and atol == last_[1]:
-                    success = True
-                    cont = True
+            # timeout; as before the ladder, Radau is only tried when LSODA
+            # fails, not when it runs out of time
+            if result == "Shiki":
+                if method == "LSODA":
+                    break
                 continue
-            else:
-                success = True
-
+            if conserve and result.t_events[2].size:
+                undershoot = True
+                continue
+            _accept(result, tolerance)
         # TODO more specific error handling
         except Exception as e:
-            if rtol == last_[0] and atol == last_[1]:
-                success = True
-                cont = True
             continue
 
-    if cont:
-        rtol_values = [1e-6, 1e-9, 1e-10]
-        atol_values = [1e-9, 1e-9, 1e-10]
-        last_ = [rtol_values[-1], atol_values[-1]]
-        success = False
-        cont = False
-        while success == False:
-            atol = atol_values.pop(0)
-            rtol = rtol_values.pop(0)
-            try:
-                result_solve_ivp = solve_ivp(
-                    dydt,
-                    t_span,
-                    initial_conc,
-                    method="BDF",
-                    dense_output=True,
-                    rtol=rtol,
-                    atol=atol,
-                    max_step=max_step,
-                    first_step=first_step,
-                    timeout=timeout,
-                )
-                # timeout
-                if result_solve_ivp == "Shiki":
-                    if rtol == last_[0] and atol == last_[1]:
-                        success = True
-                        cont = True
-                    continue
-                else:
-                    success = True
-
-            # TODO more specific error handling
-            except Exception as e:
-                if rtol == last_[0] and atol == last_[1]:
-                    success = True
-                    cont = True
-                continue
-
-    if cont:
-        try:
-            result_solve_ivp = solve_ivp(
-                dydt,
-                t_span,
-                initial_conc,
-                method="LSODA",
-                dense_output=True,
-                rtol=1e-6,
-                atol=1e-9,
-                max_step=max_step,
-                first_step=first_step,
-                timeout=timeout,
-            )
-        except Exception as e:
-            # Last resort
-            result_solve_ivp = solve_ivp(
-                dydt,
-                t_span,
-                initial_conc,
-                method="Radau",
-                dense_output=True,
-                rtol=1e-6,
-                atol=1e-9,
-                max_step=max_step,
-                first_step=first_step,
-                jac=dydt.jac,
-                timeout=timeout + 10,
-            )
+        result_solve_ivp = result
+        if warm is not None:
+            # stay on a rung the previous profile had to climb to, but probe
+            # the cheaper one again once it succeeded straight away
+            warm["attempt"] = n if n > start else max(n - 1, 0)
+            warm["first_step"] = first_accepted.h
+        break
+    if isinstance(result_solve_ivp, str) and warm is not None:
+        # nothing worked, the next profile starts from the bottom again
+        warm.pop("attempt", None)
 
     try:
         if result_solve_ivp != "Shiki":
             c_target_t = np.array([result_solve_ivp.y[i][-1]
                                   for i in idx_target_all])
+            return process_target_conc(
+                c_target_t, rxn_network_all, initial_conc, states,
+                report_as_yield), result_solve_ivp
 
-            R_idx = [i for i, s in enumerate(
-                states) if s.lower().startswith('r') and 'INT' not in s]
-            Rp = rxn_network_all[:, R_idx]
-            Rp_ = []
-            for col in range(Rp.shape[1]):
-                non_zero_values = Rp[:, col][Rp[:, col] != 0]
-                Rp_.append(non_zero_values)
-            Rp_ = np.abs([r[0] for r in Rp_])
+        else:
+            return np.array([np.nan] * len(idx_target_all)), result_solve_ivp
+    except Exception as err:
+        return np.array([np.nan] * len(idx_target_all)), result_solve_ivp
 
-            # TODO: higest conc P can be, should be refined in the future
-            upper = np.min(initial_conc[R_idx] * Rp_)
 
-            if report_as_yield:
+def calc_km_qssa(
+        k_forward_all,
+        k_reverse_all,
+        rxn_network_all,
+        t_span,
+        initial_conc,
+        states,
+        timeout,
+        report_as_yield,
+        quality=0,
+        t_eval=None):
+    """MKM with the catalyst states in quasi-steady state.
+
+    Only reactants and products are integrated. Without the fast catalyst
+    modes the system is not stiff, so LSODA starts from its own first step
+    rather than from the tiny one calc_km needs for the full model.
+
+    Returns
+    -------
+    (c_target, result_solve_ivp), with the full concentrations rebuilt in
+    ``result_solve_ivp.y``, or None if the integration failed
+    """
+    idx_target_all = [states.index(i) for i in states if "*" in i]
+    dydt = system_KE_DE(k_forward_all, k_reverse_all,
+                        rxn_network_all, initial_conc, states, qssa=True)
+    if quality < 2:
+        rtol, atol = 1e-6, 1e-9
+    else:
+        rtol, atol = 1e-9, 1e-10
 
-                c_target_yield = c_target_t / upper * 100
-                c_target_yield[c_target_yield > 100] = 100
-                c_target_yield[c_target_yield < 0] = 0
-                return c_target_yield, result_solve_ivp
+    try:
+        result_solve_ivp = solve_ivp(
+            dydt,
+            t_span,
+            initial_conc[dydt.state_idx],
+            method="LSODA",
+            t_eval=t_eval,
+            rtol=rtol,
+            atol=atol,
+            events=finished_event(dydt, states, t_span[1], rtol, atol),
+            timeout=timeout,
+        )
+        if result_solve_ivp == "Shiki":
+            return None
+        hold_plateau(result_solve_ivp, t_span[1], t_eval)
+        project_non_negative(result_solve_ivp, rtol * np.max(initial_conc))
+        result_solve_ivp.y = dydt.expand(result_solve_ivp.y)
+    except Exception as e:
+        return None
 
-            else:
-                c_target_t[c_target_t < 0] = 0
-                c_target_t = np.minimum(c_target_t, upper)
-                return c_target_t, result_solve_ivp
+    c_target_t = np.array([result_solve_ivp.y[i][-1] for i in idx_target_all])
+    return process_target_conc(
+        c_target_t, rxn_network_all, initial_conc, states,
+        report_as_yield), result_solve_ivp
 
-        else:
-            return np.array([np.NaN] * len(idx_target_all)), result_solve_ivp
-    except Exception as err:
-        return np.array([np.NaN] * len(idx_target_all)), result_solve_ivp
+
+def calc_km_linear(
+        k_forward_all,
+        k_reverse_all,
+        rxn_network_all,
+        t_span,
+        initial_conc,
+        states,
+        report_as_yield,
+        pseudo_first_order=False,
+        t_eval=None):
+    """MKM in closed form for networks with linear kinetics.
+
+    Used whenever every step is first order in the variable species. With
+    ``pseudo_first_order`` the reactants/products are also held at their
+    initial concentrations in the rate laws; that solution is only accepted
+    if they stay within PFO_RTOL of them.
+
+    Returns
+    -------
+    (c_target, result), with ``result`` sampled at t_eval (by default on
+    time_grid(t_span)), or
+    None if the network is not linear or the solution is not accepted
+    """
+    network = linear_network(rxn_network_all, states)
+    if network is None and pseudo_first_order:
+        network = linear_network(rxn_network_all, states, True)
+    if network is None:
+        return None
+
+    idx_target_all = [states.index(i) for i in states if "*" in i]
+    result_solve_ivp = solve_linear(
+        k_forward_all, k_reverse_all, network, initial_conc,
+        time_grid(t_span) if t_eval is None else t_eval)
+    if not linear_ok(result_solve_ivp.y, network, initial_conc):
+        return None
+    np.maximum(result_solve_ivp.y, 0, out=result_solve_ivp.y)
+
+    c_target_t = np.array([result_solve_ivp.y[i][-1] for i in idx_target_all])
+    return process_target_conc(
+        c_target_t, rxn_network_all, initial_conc, states,
+        report_as_yield), result_solve_ivp
+
+
+def calc_qssa_error(
+        profile,
+        c0,
+        df_network,
+        tags,
+        states,
+        temperature,
+        t_span,
+        timeout,
+        report_as_yield,
+        quality):
+    """Absolute deviation of the QSSA targets from those of the full model.
+
+    NaN if the profile is missing or either model fails; calc_km falls back
+    to the full model itself whenever the QSSA integration fails.
+    """
+    idx_target_all = [states.index(i) for i in states if "*" in i]
+    if np.isnan(profile[0]):
+        return np.array([np.nan] * len(idx_target_all))
+    try:
+        initial_conc, energy_profile_all, dgr_all, \
+            coeff_TS_all, rxn_network = process_data_mkm(
+                profile, df_network, c0, tags)
+        results = [calc_km(
+            energy_profile_all,
+            dgr_all,
+            temperature,
+            coeff_TS_all,
+            rxn_network,
+            t_span,
+            initial_conc,
+            states,
+            timeout,
+            report_as_yield,
+            quality,
+            qssa=qssa,
+            final_only=True)[0] for qssa in (False, True)]
+    except Exception:
+        return np.array([np.nan] * len(idx_target_all))
+    return np.abs(results[1] - results[0])
+
+
+def process_target_conc(
+        c_target_t,
+        rxn_network_all,
+        initial_conc,
+        states,
+        report_as_yield):
+    """Clip final target concentrations (last axis) or convert them to %yield."""
+
+    R_idx = [i for i, s in enumerate(
+        states) if s.lower().startswith('r') and 'INT' not in s]
+    Rp = rxn_network_all[:, R_idx]
+    Rp_ = []
+    for col in range(Rp.shape[1]):
+        non_zero_values = Rp[:, col][Rp[:, col] != 0]
+        Rp_.append(non_zero_values)
+    Rp_ = np.abs([r[0] for r in Rp_])
+
+    # TODO: higest conc P can be, should be refined in the future
+    upper = np.min(initial_conc[R_idx] * Rp_)
+
+    if report_as_yield:
+
+        c_target_yield = c_target_t / upper * 100
+        c_target_yield[c_target_yield > 100] = 100
+        c_target_yield[c_target_yield < 0] = 0
+        return c_target_yield
+
+    else:
+        c_target_t[c_target_t < 0] = 0
+        c_target_t = np.minimum(c_target_t, upper)
+        return c_target_t
 
 
 def process_n_calc_2d(
@@ -394,7 +718,13 @@ def process_n_calc_2d(
         timeout,
         report_as_yield,
         quality,
-        comp_ci):
+        comp_ci,
+        codegen=False,
+        qssa=False,
+        conserve=False,
+        linear=False,
+        warm=None,
+        cache=None):
 
     try:
         if np.isnan(profile[0]):
@@ -414,7 +744,14 @@ def process_n_calc_2d(
                 states,
                 timeout,
                 report_as_yield,
-                quality)
+                quality,
+                codegen=codegen,
+                qssa=qssa,
+                conserve=conserve,
+                linear=linear,
+                final_only=True,
+                warm=None if warm is None else warm.setdefault("mid", {}),
+                cache=cache)
 
             if comp_ci:
                 profile_u = profile + sigma_p
@@ -438,7 +775,14 @@ def process_n_calc_2d(
                     states,
                     timeout,
                     False,
-                    1)
+                    1,
+                    codegen=codegen,
+                    qssa=qssa,
+                    conserve=conserve,
+                    linear=linear,
+                    final_only=True,
+                    warm=None if warm is None else warm.setdefault("u", {}),
+                    cache=cache)
 
                 result_d, _ = calc_km(
                     energy_profile_all_d,
@@ -451,7 +795,14 @@ def process_n_calc_2d(
                     states,
                     timeout,
                     False,
-                    1)
+                    1,
+                    codegen=codegen,
+                    qssa=qssa,
+                    conserve=conserve,
+                    linear=linear,
+                    final_only=True,
+                    warm=None if warm is None else warm.setdefault("d", {}),
+                    cache=cache)
                 return result, np.abs(result_u - result_d) / 2
             else:
                 return result, np.zeros(n_target)
@@ -472,7 +823,13 @@ def process_n_calc_3d(
         states,
         timeout,
         report_as_yield,
-        quality):
+        quality,
+        codegen=False,
+        qssa=False,
+        conserve=False,
+        linear=False,
+        warm=None,
+        cache=None):
 
     try:
         profile = [gridj[coord] for gridj in grids]
@@ -490,7 +847,14 @@ def process_n_calc_3d(
             states,
             timeout,
             report_as_yield,
-            quality)
+            quality,
+            codegen=codegen,
+            qssa=qssa,
+            conserve=conserve,
+            linear=linear,
+            final_only=True,
+            warm=warm,
+            cache=cache)
 
         return result
 
@@ -501,6 +865,395 @@ def process_n_calc_3d(
         return np.array([np.nan] * n_target)
 
 
+def calc_km_ensemble(
+        profiles,
+        c0,
+        df_network,
+        tags,
+        states,
+        temperature,
+        t_span,
+        timeout,
+        report_as_yield,
+        quality,
+        codegen=False,
+        verb=0,
+        linear=False):
+    """MKM for many energy profiles at once with the lockstep ensemble solver.
+
+    Profiles starting with NaN are skipped (NaN result); members the ensemble
+    integrator fails on are recomputed one by one with calc_km, NaN if that
+    fails too. Networks with linear kinetics (pseudo-first-order with
+    ``linear``) are solved for all profiles at once in closed form instead.
+
+    ``timeout`` bounds the ensemble solve as a whole, not each member; the
+    calc_km fallbacks get it each.
+
+    Returns
+    -------
+    results : (n_profile, n_target) array
+    """
+    idx_target_all = [states.index(i) for i in states if "*" in i]
+    results = np.full((len(profiles), len(idx_target_all)), np.nan)
+
+    members = [i for i, profile in enumerate(profiles)
+               if not np.isnan(profile[0])]
+    if not members:
+        return results
+    # the rate constants of all members in one pass
+    profile = compile_profile(df_network, c0, tags)
+    initial_conc = profile["initial_conc"]
+    rxn_network = profile["rxn_network_all"]
+    k_forward, k_reverse = calc_k_batch(
+        *process_data_mkm_batch(np.asarray(profiles)[members],
+                                profile["layout"]),
+        temperature)
+
+    network = linear_network(rxn_network, states)
+    if network is None and linear:
+        network = linear_network(rxn_network, states, True)
+    if network is not None:
+        result_solve_ivp = solve_linear(
+            k_forward, k_reverse, network, initial_conc, [t_span[1]])
+        status = np.where(
+            linear_ok(result_solve_ivp.y, network, initial_conc), 0, -1)
+        y_final = np.maximum(np.nan_to_num(result_solve_ivp.y[..., -1]), 0)
+        if verb > 2:
+            print(f"Closed form for {len(members)}: "
+                  f"{np.count_nonzero(status)} members left to calc_km")
+    else:
+        if quality < 2:
+            rtol, atol = 1e-6, 1e-9
+        else:
+            rtol, atol = 1e-9, 1e-10
+        y_final, status, info = solve_ensemble(
+            k_forward, k_reverse, rxn_network,
+            initial_conc, t_span, rtol=rtol, atol=atol, timeout=timeout,
+            reactant_idx=[i for i, s in enumerate(states)
+                          if s.lower().startswith('r') and 'INT' not in s],
+            product_idx=[i for i, s in enumerate(states)
+                         if s.lower().startswith('p') and 'INT' not in s])
+        if verb > 2:
+            print(f"Ensemble of {len(members)}: {info['n_iter']} iterations, "
+                  f"{np.count_nonzero(status)} members left to calc_km")
+
+    results[members] = process_target_conc(
+        y_final[:, idx_target_all], rxn_network, initial_conc, states,
+        report_as_yield)
+
+    for m in np.where(status != 0)[0]:
+        try:
+            initial_conc, energy_profile_all, dgr_all, \
+                coeff_TS_all, rxn_network = process_data_mkm(
+                    profiles[members[m]], df_network, c0, tags)
+            results[members[m]], _ = calc_km(
+                energy_profile_all,
+                dgr_all,
+                temperature,
+                coeff_TS_all,
+                rxn_network,
+                t_span,
+                initial_conc,
+                states,
+                timeout,
+                report_as_yield,
+                quality,
+                codegen=codegen,
+                linear=linear,
+                final_only=True)
+        except Exception as e:
+            if verb > 1:
+                print(f"Fail to compute at point {profiles[members[m]]} "
+                      f"due to {e}")
+            results[members[m]] = np.nan
+
+    return results
+
+
+def calc_km_ensemble_batches(profiles, batch_size, ncore, *args, **kwargs):
+    """Split profiles into ensembles of batch_size and solve them on ncore."""
+    n_batch = max(1, int(np.ceil(len(profiles) / batch_size)))
+    results = run_pool(
+        calc_km_ensemble,
+        [(batch,) for batch in np.array_split(np.asarray(profiles), n_batch)],
+        ncore, *args, progress=False, **kwargs)
+    return np.vstack(results)
+
+
+def calc_warm_chain(func, items, *args, **kwargs):
+    """Call func(*item, *args, **kwargs) for items in order, each solve
+    warm-started from the previous one."""
+    warm = {}
+    return [func(*item, *args, warm=warm, **kwargs) for item in items]
+
+
+def calc_warm_chains(func, items, ncore, *args, order=None, segment=16,
+                     cost=None, on_result=None, **kwargs):
+    """Solve items as warm-started chains of neighbours on ncore.
+
+    ``order`` is a locality-preserving ordering of the items (default: as
+    given); it is cut into contiguous segments of about ``segment`` items,
+    each solved as one chain by a worker, the costliest chains (by the
+    summed ``cost`` of their items) first. ``on_result(i, result)`` is
+    called for the items of every finished chain. Returns the results in
+    item order.
+    """
+    order = np.arange(len(items)) if order is None else np.asarray(order)
+    n_seg = min(len(order), max(ncore, len(order) // segment))
+    segments = np.array_split(order, max(n_seg, 1))
+    if cost is not None:
+        cost = [np.nansum(np.asarray(cost)[seg]) for seg in segments]
+
+    def chain_done(s, chain):
+        for i, res in zip(segments[s], chain):
+            on_result(i, res)
+
+    chains = run_pool(
+        calc_warm_chain, [(func, [items[i] for i in seg]) for seg in segments],
+        ncore, *args, cost=cost,
+        on_result=None if on_result is None else chain_done, **kwargs)
+    results = [None] * len(items)
+    for seg, chain in zip(segments, chains):
+        for i, res in zip(seg, chain):
+            results[i] = res
+    return results
+
+
+def resume_solve(solve, ckpt, idx):
+    """solve(idx) for the items of idx not done in the Checkpoint ckpt.
+
+    The other items are read back from the checkpoint. solve may record its
+    results as they complete; all of them are recorded once it returns.
+    """
+    idx = np.asarray(idx, dtype=int)
+    done = ckpt.done[idx]
+    values = np.empty((len(idx), ckpt.values.shape[1]))
+    values[done] = ckpt.values[idx[done]]
+    if not done.all():
+        try:
+            values[~done] = solve(idx[~done])
+            ckpt.write(idx[~done], values[~done])
+        finally:
+            ckpt.flush()
+    return values
+
+
+def update_output(files, folder):
+    """Move files into folder, replacing those of a previous run."""
+    os.makedirs(folder, exist_ok=True)
+    for file_name in files:
+        os.replace(file_name, os.path.join(folder, os.path.basename(file_name)))
+
+
+def tof_cost(profiles, df_network, c0, tags, temperature):
+    """Predicted relative solve cost of reaction_data rows.
+
+    The highest log10 TOF of the cycles (energetic span model): the more
+    turnovers in the time span, the more steps the integrator takes, while
+    a profile with a high span hardly reacts and is solved quickly. NaN for
+    profiles with missing energies.
+    """
+    layout = compile_profile(df_network, c0, tags)["layout"]
+    return np.max(calc_es_tof(profiles, layout, temperature)[0], axis=1)
+
+
+def serpentine(nx, ny):
+    """Flat indices of an nx x ny grid (row-major) in boustrophedon order."""
+    idx = np.arange(nx * ny).reshape(nx, ny)
+    idx[1::2] = idx[1::2, ::-1]
+    return idx.ravel()
+
+
+def sample_line_adaptive(solve, x, rtol, n_init=17):
+    """Pick the points of the volcano line x to solve adaptively.
+
+    Starts from n_init evenly spaced points, then bisects (a round of solves
+    at a time) the intervals where the local interpolation error estimate
+    exceeds rtol of the range of any target.
+    Intervals next to a failed point are left to the final interpolation.
+
+    Parameters
+    ----------
+    solve : callable
+        solve(idx) returns the (len(idx), n_target) results at x[idx]
+    x : array
+        descriptor values of the line
+    rtol : float
+        tolerance, as a fraction of the range of the results
+    n_init : int
+        number of points of the first round
+
+    Returns
+    -------
+    y : (len(x), n_target) array
+        results, NaN where not solved
+    solved : bool array
+    """
+    n = len(x)
+    idx = np.unique(np.round(np.linspace(0, n - 1, min(n_init, n))).astype(int))
+    solved = np.zeros(n, dtype=bool)
+    y = None
+    while idx.size > 0:
+        res = np.asarray(solve(idx), dtype=np.float64)
+        if y is None:
+            y = np.full((n, res.shape[1]), np.nan)
+        y[idx] = res
+        solved[idx] = True
+
+        pts = np.where(solved)[0]
+        valid = ~np.any(np.isnan(y), axis=1)
+        ok = pts[valid[pts]]
+        if ok.size < 4:
+            break
+        left, right = pts[:-1], pts[1:]
+        split = (right - left > 1) & valid[left] & valid[right]
+        mid = (left[split] + right[split]) // 2
+        if mid.size == 0:
+            break
+        # local error estimate: the two quadratics through the interval and
+        # one neighbour on either side disagree by ~ f''' h^3
+        err = np.empty((mid.size, y.shape[1]))
+        for j, k in enumerate(np.searchsorted(ok, left[split])):
+            lo = min(max(k - 1, 0), ok.size - 4)
+            stencil = ok[lo:lo + 4]
+            q1 = np.polyfit(x[stencil[:3]], y[stencil[:3]], 2)
+            q2 = np.polyfit(x[stencil[1:]], y[stencil[1:]], 2)
+            err[j] = np.abs(np.polyval(q1, x[mid[j]]) -
+                            np.polyval(q2, x[mid[j]]))
+        tol = rtol * np.ptp(y[ok], axis=0) + \
+            np.sqrt(np.finfo(np.float64).eps) * np.max(np.abs(y[ok]), axis=0)
+        idx = mid[np.any(err > tol, axis=1)]
+    return y, solved
+
+
+def _map_measures(values):
+    """Activity (and, for two targets, clipped log10 selectivity) of cells."""
+    measures = [np.sum(values, axis=-1)]
+    if values.shape[-1] == 2:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            measures.append(np.clip(
+                np.log10(values[..., 0] / values[..., 1]), -20, 20))
+    return np.stack(measures, axis=-1)
+
+
+def refine_map_adaptive(solve, nx, ny, rtol, n_init=17):
+    """Solve an nx x ny map on an adaptively refined quadtree.
+
+    A coarse lattice of about n_init x n_init cells is solved first, with
+    the centre of every cell. Round by round, the cells where the bilinear
+    interpolation of the corners misses the centre in activity or
+    selectivity by more than rtol of its range over the map are split in four (in two
+    along an axis with no room left), solving the new corners and centres.
+    Cells with a failed corner or centre are split down to unit cells. The
+    points inside the final cells are filled by bilinear interpolation of
+    their solved corners, finer cells taking precedence.
+
+    Parameters
+    ----------
+    solve : callable
+        solve(coords) returns the (len(coords), n_target) results at the
+        list of (k, l) grid indices
+    nx, ny : int
+        grid shape
+    rtol : float
+        tolerance, as a fraction of the range of activity/selectivity
+    n_init : int
+        number of lattice points per axis of the first round
+
+    Returns
+    -------
+    grid_d : (n_target, nx, ny) array
+    solved : (nx, ny) bool array
+    """
+    def centre(cell):
+        i0, i1, j0, j1 = cell
+        if i1 - i0 < 2 and j1 - j0 < 2:
+            return None
+        return (i0 + i1) // 2, (j0 + j1) // 2
+
+    def bilinear(values, cell, i, j):
+        # values[..., k, l] at the corners, evaluated at grid indices i, j;
+        # failed corners are left out and the weights of the others rescaled
+        i0, i1, j0, j1 = cell
+        u = (np.asarray(i) - i0) / (i1 - i0)
+        v = (np.asarray(j) - j0) / (j1 - j0)
+        total = weight = 0
+        for corner, w in zip(
+                [values[..., i0, j0], values[..., i0, j1],
+                 values[..., i1, j0], values[..., i1, j1]],
+                [np.outer(1 - u, 1 - v), np.outer(1 - u, v),
+                 np.outer(u, 1 - v), np.outer(u, v)]):
+            ok = np.isfinite(corner)
+            total = total + np.multiply.outer(np.where(ok, corner, 0), w)
+            weight = weight + np.multiply.outer(ok, w)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(weight > 0, total / weight, np.nan)
+
+    xs = np.unique(np.round(np.linspace(0, nx - 1, min(n_init, nx))).astype(int))
+    ys = np.unique(np.round(np.linspace(0, ny - 1, min(n_init, ny))).astype(int))
+    cells = [(xs[a], xs[a + 1], ys[b], ys[b + 1])
+             for a in range(len(xs) - 1) for b in range(len(ys) - 1)]
+    pending = set(itertools.product(xs, ys))
+    pending.update(centre(cell) for cell in cells if centre(cell))
+    solved = np.zeros((nx, ny), dtype=bool)
+    grid_d = None
+    leaves = []
+    while pending:
+        coords = sorted(c for c in pending if not solved[c])
+        res = np.asarray(solve(coords), dtype=np.float64)
+        if grid_d is None:
+            grid_d = np.full((res.shape[1], nx, ny), np.nan)
+        for coord, r in zip(coords, res):
+            grid_d[(slice(None),) + coord] = r
+            solved[coord] = True
+
+        measures = np.moveaxis(
+            _map_measures(np.moveaxis(grid_d, 0, -1)), -1, 0)
+        known = measures[:, solved]
+        with np.errstate(invalid="ignore"):
+            tol = rtol * (np.nanmax(known, axis=1) - np.nanmin(known, axis=1)) \
+                + np.sqrt(np.finfo(np.float64).eps) * \
+                np.nanmax(np.abs(known), axis=1)
+
+        pending = set()
+        refined = []
+        for cell in cells:
+            c = centre(cell)
+            if c is None:
+                leaves.append(cell)
+                continue
+            # compared the way the cell would be filled; a failed corner or
+            # centre is not, it is closed in down to unit cells
+            i0, i1, j0, j1 = cell
+            err = np.abs(measures[:, c[0], c[1]] - _map_measures(
+                bilinear(grid_d, cell, [c[0]], [c[1]])[:, 0, 0]))
+            failed = not np.all(np.isfinite(
+                grid_d[:, [i0, i0, i1, i1, c[0]], [j0, j1, j0, j1, c[1]]]))
+            if not failed and not np.any(err > tol):
+                leaves.append(cell)
+                continue
+            xi = [i0, c[0], i1] if i1 - i0 > 1 else [i0, i1]
+            yj = [j0, c[1], j1] if j1 - j0 > 1 else [j0, j1]
+            for a in range(len(xi) - 1):
+                for b in range(len(yj) - 1):
+                    child = (xi[a], xi[a + 1], yj[b], yj[b + 1])
+                    refined.append(child)
+                    if centre(child):
+                        pending.add(centre(child))
+            pending.update(itertools.product(xi, yj))
+        cells = refined
+
+    # bilinear fill, largest cells first so that finer ones overwrite them
+    fill = grid_d.copy()
+    for i0, i1, j0, j1 in sorted(
+            leaves, key=lambda c: (c[1] - c[0]) * (c[3] - c[2]), reverse=True):
+        fill[:, i0:i1 + 1, j0:j1 + 1] = bilinear(
+            grid_d, (i0, i1, j0, j1), np.arange(i0, i1 + 1),
+            np.arange(j0, j1 + 1))
+    fill[:, solved] = grid_d[:, solved]
+    return fill, solved
+
+
 if __name__ == "__main__":
 
     # Input
@@ -512,7 +1265,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "-d",
         "--dir",
-        help="directory containing all required input files (profile, reaction network, initial conc)"
+        help="directory containing all required input files (profile, reaction network, initial conc); the results are also streamed to mkm_checkpoint.h5 there, which is rewritten on every run (see -rs), and the LFESR fit to lfesr_regression.npz (see -rf)"
     )
 
     parser.add_argument(
@@ -641,6 +1394,7 @@ if __name__ == "__main__":
         0: run mkm for every profiles
         1: construct MKM volcano plot
         2: construct MKM activity/selectivity map
+        3: construct energetic span (TOF) volcano plot, a quick pre-screen without MKM
         """,
     )
     parser.add_argument(
@@ -676,6 +1430,93 @@ if __name__ == "__main__":
         default=1,
         help="number of cpu cores for the parallel computing (default: 1)",
     )
+    parser.add_argument(
+        "-ens",
+        "--ensemble",
+        dest="ensemble",
+        type=int,
+        default=0,
+        help="""Solve volcano line/points and map cells with the lockstep ensemble integrator, in batches of this many profiles (0: off). (default: 0)""",
+    )
+    parser.add_argument(
+        "-qssa",
+        "--qssa",
+        dest="qssa",
+        action="store_true",
+        help="""Toggle to treat the catalyst states in quasi-steady state and integrate only reactants/products (not used by the ensemble integrator). (default: False)""",
+    )
+    parser.add_argument(
+        "-qc",
+        "--qssa_check",
+        dest="qssa_check",
+        action="store_true",
+        help="""Toggle to report the deviation of the QSSA from the full model for every entry of the reaction data. (default: False)""",
+    )
+    parser.add_argument(
+        "-cons",
+        "--conserve",
+        dest="conserve",
+        action="store_true",
+        help="""Toggle to eliminate the catalyst state fixed by the catalyst total from the integrated system (falls back to the full system if the reduced one fails). (default: False)""",
+    )
+    parser.add_argument(
+        "-lin",
+        "--linear",
+        dest="linear",
+        action="store_true",
+        help="""Toggle to hold reactants/products at their initial concentrations (large excess) and solve the then linear kinetics in closed form; falls back to the integrator if they change by more than 5%%. Linear networks always use the closed form. (default: False)""",
+    )
+    parser.add_argument(
+        "-as",
+        "--adaptive",
+        dest="adaptive",
+        type=float,
+        default=0,
+        help="""Sample the volcano line/map adaptively instead of solving every point: line intervals and map quadtree cells are bisected until their estimated interpolation error is below this fraction of the activity/selectivity range, e.g. 0.01 (0: off). (default: 0)""",
+    )
+    parser.add_argument(
+        "-ws",
+        "--warm_start",
+        dest="warm_start",
+        action="store_true",
+        help="""Toggle to solve neighbouring volcano line points and map cells in chains, each solve starting from the solver, tolerance and step size that worked for the previous one (not used by the ensemble integrator). (default: False)""",
+    )
+    parser.add_argument(
+        "-rs",
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="""Toggle to resume the volcano line/points or map from mkm_checkpoint.h5 in the directory, where the results are streamed as they are solved; only done on the same inputs and settings. (default: False)""",
+    )
+    parser.add_argument(
+        "-ic",
+        "--incremental",
+        dest="incremental",
+        type=float,
+        default=None,
+        help="""Rerun incrementally on the previous run of the directory (mkm_checkpoint.h5), e.g. after adding catalysts to reaction_data: only new or changed catalysts are solved, and the volcano line/map points whose refitted LFESR energies moved by more than this tolerance (kcal/mol), e.g. 0.05; the output is updated in place. Implies --resume. (default: None)""",
+    )
+    parser.add_argument(
+        "-rc",
+        "--result_cache",
+        dest="result_cache",
+        action="store_true",
+        help="""Toggle to look up the volcano line/points and map results in the result cache ($SPECTRE_CACHE or ~/.cache/spectre, shared by all runs) before solving, and to store them there. (default: False)""",
+    )
+    parser.add_argument(
+        "-rf",
+        "--refit",
+        dest="refit",
+        action="store_true",
+        help="""Toggle to redo the data curation, descriptor choice and LFESR regression instead of loading them from lfesr_regression.npz in the directory, where they are kept for the next run on the same reaction data and regression settings. (default: False)""",
+    )
+    parser.add_argument(
+        "-cg",
+        "--codegen",
+        dest="codegen",
+        action="store_true",
+        help="""Toggle to use rate/Jacobian kernels generated for the network (cached on disk, JIT-compiled if numba is installed). (default: False)""",
+    )
 
     # %% loading and processing------------------------------------------------------------------------#
     args = parser.parse_args()
@@ -696,6 +1537,19 @@ if __name__ == "__main__":
     comp_ci = args.confidence_interval
     ncore = args.ncore
     nd = args.run_mode
+    codegen = args.codegen
+    ensemble = args.ensemble
+    qssa = args.qssa
+    qssa_check = args.qssa_check
+    conserve = args.conserve
+    linear = args.linear
+    warm_start = args.warm_start
+    adaptive = args.adaptive
+    incremental = args.incremental is not None
+    resume = args.resume or incremental
+    refit = args.refit
+    tol = args.incremental if incremental else 0.0
+    cache = result_cache_path() if args.result_cache else None
 
     filename_xlsx = f"{wdir}reaction_data.xlsx"
     filename_csv = f"{wdir}reaction_data.csv"
@@ -708,8 +1562,10 @@ if __name__ == "__main__":
 
     try:
         df = pd.read_excel(filename_xlsx)
+        filename_data = filename_xlsx
     except FileNotFoundError as e:
         df = pd.read_csv(filename_csv)
+        filename_data = filename_csv
     clear = check_km_inp(df, df_network)
     if not (clear):
         print("\nRecheck your reaction network and your reaction data\n")
@@ -782,135 +1638,215 @@ if __name__ == "__main__":
             coeff[i] = False
             regress[i] = True
 
-    d, cb, ms = curate_d(d, regress, cb, ms, tags,
-                         imputer_strat, nstds=3, verb=verb)
+    # the curated data, descriptor choice and regression are kept for the
+    # next run on the same reaction data (the LFESR plots are redone though)
+    reg_path = f"{wdir}lfesr_regression.npz"
+    reg_key = regression_key(
+        [filename_data], nd, imputer_strat, lmargin, rmargin, npoints,
+        lfesrs_idx)
+    regression = None
+    if not (refit or lfesr):
+        regression = load_regression(reg_path, reg_key)
+    if regression is None:
+        d, cb, ms = curate_d(d, regress, cb, ms, tags,
+                             imputer_strat, nstds=3, verb=verb)
+        fitted = dict(d_curated=d, cb=cb, ms=ms)
+    else:
+        if verb > 0:
+            print(f"Using the curated data and LFESRs of {reg_path}")
+        d, cb, ms = regression["d_curated"], regression["cb"], regression["ms"]
+
+    if qssa:
+        try:
+            compile_qssa(compile_rxn_network(process_data_mkm(
+                d[0], df_network, c0, tags)[-1]), states)
+        except ValueError as e:
+            print(f"QSSA not applicable, using the full model: {e}")
+            qssa = False
+            qssa_check = False
+
+    if linear and linear_network(process_data_mkm(
+            d[0], df_network, c0, tags)[-1], states, True) is None:
+        print("Closed form not applicable, the network is not "
+              "pseudo-first-order in the catalyst states")
+        linear = False
+
+    if qssa_check:
+        if verb > 0:
+            print(f"Comparing QSSA with the full model ({len(d)})")
+        qssa_err = np.array(Parallel(n_jobs=ncore)(
+            delayed(calc_qssa_error)(
+                profile,
+                c0,
+                df_network,
+                tags,
+                states,
+                temperature,
+                t_span,
+                timeout,
+                report_as_yield,
+                quality) for profile in d))
+        prod_names = [i.replace("*", "") for i in states if "*" in i]
+        print("\n-------------QSSA deviation from the full model-------------\n")
+        for i, prod_name in enumerate(prod_names):
+            if np.all(np.isnan(qssa_err[:, i])):
+                print(f"--[{prod_name}]: no comparison available--")
+                continue
+            worst = np.nanargmax(qssa_err[:, i])
+            print(f"--[{prod_name}]: max {qssa_err[worst, i]:.4f} "
+                  f"({names[worst]}), mean {np.nanmean(qssa_err[:, i]):.4f}--")
+        if verb > 1:
+            data_dict = dict()
+            data_dict["entry"] = names
+            for i in range(len(prod_names)):
+                data_dict[prod_names[i]] = qssa_err[:, i]
+            pd.DataFrame(data_dict).to_csv('qssa_error.csv', index=False)
 
     # %% selecting modes----------------------------------------------------------#
     if nd == 0:
         evol_mode = True
-    elif nd == 1:
+    elif nd in (1, 3):
         from navicat_volcanic.plotting2d import get_reg_targets
-        dvs, r2s = find_1_dv(d, tags, coeff, regress, verb)
-        if lfesrs_idx:
-            idx = lfesrs_idx[0]
-            if verb > 1:
-                print(f"\n**Manually chose {tags[idx]} as descriptor****\n")
+        if regression is not None:
+            X, d, coeff, xint, dgs, sigma_dgs = (
+                regression[name]
+                for name in ("X", "d", "coeff", "xint", "dgs", "sigma_dgs"))
+            tag = str(regression["tag"])
+            tags = np.array(regression["tags"], dtype=object)
+            xmin, xmax = float(regression["xmin"]), float(regression["xmax"])
         else:
-            idx = user_choose_1_dv(dvs, r2s, tags)  # choosing descp
-        if lfesr:
-            d = plot_2d_lsfer(
-                idx,
-                d,
-                tags,
-                coeff,
-                regress,
-                cb,
-                ms,
-                lmargin,
-                rmargin,
-                npoints,
-                plotmode,
-                verb,
-            )
-            lfesr_csv = [s + ".csv" for s in tags[1:]]
-            all_lfsers = [s + ".png" for s in tags[1:]]
-            all_lfsers.extend(lfesr_csv)
-            if not os.path.isdir("lfesr"):
-                os.makedirs("lfesr")
-            for file_name in all_lfsers:
-                source_file = os.path.abspath(file_name)
-                destination_file = os.path.join(
-                    "lfesr/", os.path.basename(file_name))
-                shutil.move(source_file, destination_file)
-
-        X, tag, tags, d, d2, coeff = get_reg_targets(
-            idx, d, tags, coeff, regress, mode="k")
-
-        lnsteps = range(d.shape[1])
-        xmax = bround(X.max() + rmargin, xbase)
-        xmin = bround(X.min() - lmargin, xbase)
+            dvs, r2s = find_1_dv(d, tags, coeff, regress, verb)
+            if lfesrs_idx:
+                idx = lfesrs_idx[0]
+                if verb > 1:
+                    print(f"\n**Manually chose {tags[idx]} as descriptor****\n")
+            else:
+                idx = user_choose_1_dv(dvs, r2s, tags)  # choosing descp
+            if lfesr:
+                d = plot_2d_lsfer(
+                    idx,
+                    d,
+                    tags,
+                    coeff,
+                    regress,
+                    cb,
+                    ms,
+                    lmargin,
+                    rmargin,
+                    npoints,
+                    plotmode,
+                    verb,
+                )
+                lfesr_csv = [s + ".csv" for s in tags[1:]]
+                all_lfsers = [s + ".png" for s in tags[1:]]
+                all_lfsers.extend(lfesr_csv)
+                if not os.path.isdir("lfesr"):
+                    os.makedirs("lfesr")
+                for file_name in all_lfsers:
+                    source_file = os.path.abspath(file_name)
+                    destination_file = os.path.join(
+                        "lfesr/", os.path.basename(file_name))
+                    shutil.move(source_file, destination_file)
+
+            X, tag, tags, d, d2, coeff = get_reg_targets(
+                idx, d, tags, coeff, regress, mode="k")
+
+            lnsteps = range(d.shape[1])
+            xmax = bround(X.max() + rmargin, xbase)
+            xmin = bround(X.min() - lmargin, xbase)
 
-        if verb > 1:
-            print(f"Range of descriptor set to [ {xmin} , {xmax} ]")
-        xint = np.linspace(xmin, xmax, npoints)
-        dgs = np.zeros((npoints, len(lnsteps)))
-        sigma_dgs = np.zeros((npoints, len(lnsteps)))
-        for i, j in enumerate(lnsteps):
-            Y = d[:, j].reshape(-1)
-            p, cov = np.polyfit(X, Y, 1, cov=True)
-            Y_pred = np.polyval(p, X)
-            n = Y.size
-            m = p.size
-            dof = n - m
-            resid = Y - Y_pred
-            with np.errstate(invalid="ignore"):
-                chi2 = np.sum((resid / Y_pred) ** 2)
-            yint = np.polyval(p, xint)
-            ci = calc_ci(resid, n, dof, X, xint, yint)
-            dgs[:, i] = yint
-            sigma_dgs[:, i] = ci
-
-        # TODO For some reason, sometimes the volcanic drops the last state
-        # Kinda adhoc fix for now
-        tags_ = np.array([str(tag) for tag in df.columns[1:]], dtype=object)
-        if tags_[-1] not in tags and tags_[-1].lower().startswith("p"):
-            print("\n***Forgot the last state******\n")
-            d_ = np.float32(df.to_numpy()[:, 1:])
-
-            dgs = np.column_stack((dgs, np.full((npoints, 1), d_[-1, -1])))
-            d = np.column_stack((d, np.full((d.shape[0], 1), d_[-1, -1])))
-            tags = np.append(tags, tags_[-1])
-            sigma_dgs = np.column_stack((sigma_dgs, np.full((npoints, 1), 0)))
+            if verb > 1:
+                print(f"Range of descriptor set to [ {xmin} , {xmax} ]")
+            xint = np.linspace(xmin, xmax, npoints)
+            # all LFESRs in one fit
+            coef, resid = fit_lfesr(d[:, lnsteps], X)
+            dgs = predict_lfesr(coef, xint)
+            sigma_dgs = lfesr_ci(resid, [X], [xint])
+
+            # TODO For some reason, sometimes the volcanic drops the last state
+            # Kinda adhoc fix for now
+            tags_ = np.array([str(tag) for tag in df.columns[1:]], dtype=object)
+            if tags_[-1] not in tags and tags_[-1].lower().startswith("p"):
+                print("\n***Forgot the last state******\n")
+                d_ = np.float32(df.to_numpy()[:, 1:])
+
+                dgs = np.column_stack((dgs, np.full((npoints, 1), d_[-1, -1])))
+                d = np.column_stack((d, np.full((d.shape[0], 1), d_[-1, -1])))
+                tags = np.append(tags, tags_[-1])
+                sigma_dgs = np.column_stack((sigma_dgs, np.full((npoints, 1), 0)))
+            fitted.update(X=X, tag=tag, tags=tags, d=d, coeff=coeff,
+                          xmin=xmin, xmax=xmax, xint=xint, dgs=dgs,
+                          sigma_dgs=sigma_dgs)
 
     elif nd == 2:
         from navicat_volcanic.plotting3d import get_reg_targets
-        dvs, r2s = find_2_dv(d, tags, coeff, regress, verb)
-        if lfesrs_idx:
-            assert len(lfesrs_idx) == 2
-            "Require 2 lfesrs_idx for activity/seclectivity map"
-            idx1, idx2 = lfesrs_idx
-            if verb > 1:
-                print(
-                    f"\n**Manually chose {tags[idx1]} and {tags[idx2]} as descriptor****\n")
+        if regression is not None:
+            X1, X2, d, coeff, xint, yint = (
+                regression[name]
+                for name in ("X1", "X2", "d", "coeff", "xint", "yint"))
+            tag1, tag2 = str(regression["tag1"]), str(regression["tag2"])
+            tags = np.array(regression["tags"], dtype=object)
+            x1base, x2base, x1min, x1max, x2min, x2max = (
+                float(regression[name]) for name in (
+                    "x1base", "x2base", "x1min", "x1max", "x2min", "x2max"))
+            grids = list(regression["grids"])
         else:
-            idx1, idx2 = user_choose_2_dv(dvs, r2s, tags)
+            dvs, r2s = find_2_dv(d, tags, coeff, regress, verb)
+            if lfesrs_idx:
+                assert len(lfesrs_idx) == 2
+                "Require 2 lfesrs_idx for activity/seclectivity map"
+                idx1, idx2 = lfesrs_idx
+                if verb > 1:
+                    print(
+                        f"\n**Manually chose {tags[idx1]} and {tags[idx2]} as descriptor****\n")
+            else:
+                idx1, idx2 = user_choose_2_dv(dvs, r2s, tags)
 
-        X1, X2, tag1, tag2, tags, d, d2, coeff = get_reg_targets(
-            idx1, idx2, d, tags, coeff, regress, mode="k"
-        )
-        x1base, x2base = get_bases(X1, X2)
-        lnsteps = range(d.shape[1])
-        x1max = bround(X1.max() + rmargin, x1base, "max")
-        x1min = bround(X1.min() - lmargin, x1base, "min")
-        x2max = bround(X2.max() + rmargin, x2base, "max")
-        x2min = bround(X2.min() - lmargin, x2base, "min")
-        if verb > 1:
-            print(
-                f"Range of descriptors set to [ {x1min} , {x1max} ] and [ {x2min} , {x2max} ]"
+            X1, X2, tag1, tag2, tags, d, d2, coeff = get_reg_targets(
+                idx1, idx2, d, tags, coeff, regress, mode="k"
             )
-        xint = np.linspace(x1min, x1max, npoints)
-        yint = np.linspace(x2min, x2max, npoints)
-        grids = []
-        for i, j in enumerate(lnsteps):
-            XY = np.vstack([X1, X2, d[:, j]]).T
-            X = XY[:, :2]
-            Y = XY[:, 2]
-            reg = sk.linear_model.LinearRegression().fit(X, Y)
-            Y_pred = reg.predict(X)
-            gridj = np.zeros((npoints, npoints))
-            for k, x1 in enumerate(xint):
-                for l, x2 in enumerate(yint):
-                    x1x2 = np.vstack([x1, x2]).reshape(1, -1)
-                    gridj[k, l] = reg.predict(x1x2)
-            grids.append(gridj)
-
-        tags_ = np.array([str(tag) for tag in df.columns[1:]], dtype=object)
-        if len(grids) != len(tags_) and tags_[-1].lower().startswith("p"):
-            print("\n***Forgot the last state******\n")
-            d_ = np.float32(df.to_numpy()[:, 1:])
-
-            grids.append(np.full(((npoints, npoints)), d_[-1, -1]))
-            tags = np.append(tags, tags_[-1])
+            x1base, x2base = get_bases(X1, X2)
+            lnsteps = range(d.shape[1])
+            x1max = bround(X1.max() + rmargin, x1base, "max")
+            x1min = bround(X1.min() - lmargin, x1base, "min")
+            x2max = bround(X2.max() + rmargin, x2base, "max")
+            x2min = bround(X2.min() - lmargin, x2base, "min")
+            if verb > 1:
+                print(
+                    f"Range of descriptors set to [ {x1min} , {x1max} ] and [ {x2min} , {x2max} ]"
+                )
+            xint = np.linspace(x1min, x1max, npoints)
+            yint = np.linspace(x2min, x2max, npoints)
+            # all LFESRs in one fit, projected on the whole grid at once
+            coef, _ = fit_lfesr(d[:, lnsteps], X1, X2)
+            grids = list(np.moveaxis(predict_lfesr(coef, xint, yint), -1, 0))
+
+            tags_ = np.array([str(tag) for tag in df.columns[1:]], dtype=object)
+            if len(grids) != len(tags_) and tags_[-1].lower().startswith("p"):
+                print("\n***Forgot the last state******\n")
+                d_ = np.float32(df.to_numpy()[:, 1:])
+
+                grids.append(np.full(((npoints, npoints)), d_[-1, -1]))
+                tags = np.append(tags, tags_[-1])
+            fitted.update(X1=X1, X2=X2, tag1=tag1, tag2=tag2, tags=tags, d=d,
+                          coeff=coeff, x1base=x1base, x2base=x2base,
+                          x1min=x1min, x1max=x1max, x2min=x2min, x2max=x2max,
+                          xint=xint, yint=yint, grids=np.asarray(grids))
+
+    if regression is None:
+        save_regression(reg_path, reg_key, **fitted)
+
+    # sweeps are checkpointed with the energies of their points, a resumed
+    # point is only kept on the same (within tol) energies and settings
+    ckpt_path = f"{wdir}mkm_checkpoint.h5"
+
+    def sweep_key(*settings):
+        profile = compile_profile(df_network, c0, tags)
+        return checkpoint_key(
+            profile["rxn_network_all"], profile["initial_conc"],
+            [str(tag) for tag in tags], states, temperature, t_span, timeout,
+            report_as_yield, quality, qssa, conserve, linear, ensemble,
+            warm_start, *settings)
 
     # %% evol mode----------------------------------------------------------------#
     if nd == 0:
@@ -943,7 +1879,11 @@ if __name__ == "__main__":
                     states,
                     timeout,
                     report_as_yield,
-                    quality)
+                    quality,
+                    codegen=codegen,
+                    qssa=qssa,
+                    conserve=conserve,
+                    linear=linear)
                 if len(result) != n_target:
                     prod_conc_pt.append(np.array([np.nan] * n_target))
                 else:
@@ -1009,7 +1949,12 @@ I'll find happiness in abundance""")
             print("\n------------Constructing MKM volcano plot------------------\n")
 
         # Volcano line
-        if interpolate:
+        if adaptive:
+            if verb > 0:
+                print(
+                    "Performing microkinetics modelling for the volcano line (adaptive sampling)")
+            trun_dgs = dgs
+        elif interpolate:
             if verb > 0:
                 print(
                     f"Performing microkinetics modelling for the volcano line ({n_point_calc} points)")
@@ -1034,31 +1979,80 @@ I'll find happiness in abundance""")
         prod_conc = np.zeros((len(dgs), n_target))
         ci = np.zeros((len(dgs), n_target))
 
-        dgs_g = np.array_split(trun_dgs, len(trun_dgs) // ncore + 1)
-        sigma_dgs_g = np.array_split(sigma_dgs, len(sigma_dgs) // ncore + 1)
-        i = 0
-        for batch_dgs, batch_s_dgs in tqdm(
-                zip(dgs_g, sigma_dgs_g), total=len(dgs_g), ncols=80):
-            results = Parallel(
-                n_jobs=ncore)(
-                delayed(process_n_calc_2d)(
-                    profile,
-                    sigma_dgs,
-                    c0,
-                    df_network,
-                    tags,
-                    states,
-                    timeout,
-                    report_as_yield,
-                    quality,
-                    comp_ci) for profile,
-                sigma_dgs in zip(
-                    batch_dgs,
-                    batch_s_dgs))
-            for j, res in enumerate(results):
-                prod_conc[i, :] = res[0]
-                ci[i, :] = res[1]
-                i += 1
+        ens_args = (c0, df_network, tags, states, temperature, t_span,
+                    timeout)
+
+        line_time = np.full(len(dgs), np.nan)
+        # points whose refitted LFESR energies moved less than the
+        # tolerance keep their results
+        line_ckpt = Checkpoint(
+            ckpt_path, "volcano_line", len(dgs), 2 * n_target,
+            sweep_key(comp_ci), resume,
+            inputs=np.column_stack((trun_dgs, sigma_dgs)), tol=tol)
+
+        def solve_line_todo(idx):
+            line_dgs = np.asarray(trun_dgs)[idx]
+            line_s_dgs = sigma_dgs[idx]
+            # the results, then their CI
+            values = np.zeros((len(idx), 2 * n_target))
+            # longest first: as the nearest point of an earlier round, else
+            # by the TOF
+            cost = nearest_cost(xint, line_time, xint[idx])
+            if cost is None:
+                cost = tof_cost(line_dgs, df_network, c0, tags, temperature)
+
+            def record(i, res):
+                line_ckpt.write(idx[i], np.concatenate(res))
+
+            if ensemble:
+                values[:, :n_target] = calc_km_ensemble_batches(
+                    line_dgs, ensemble, ncore, *ens_args, report_as_yield,
+                    quality, codegen=codegen, verb=verb, linear=linear)
+                if comp_ci:
+                    result_u = calc_km_ensemble_batches(
+                        line_dgs + line_s_dgs, ensemble, ncore, *ens_args,
+                        False, 1, codegen=codegen, verb=verb, linear=linear)
+                    result_d = calc_km_ensemble_batches(
+                        line_dgs - line_s_dgs, ensemble, ncore, *ens_args,
+                        False, 1, codegen=codegen, verb=verb, linear=linear)
+                    values[:, n_target:] = np.abs(result_u - result_d) / 2
+            elif warm_start:
+                results = calc_warm_chains(
+                    process_n_calc_2d, list(zip(line_dgs, line_s_dgs)), ncore,
+                    c0, df_network, tags, states, timeout, report_as_yield,
+                    quality, comp_ci, cost=cost, on_result=record,
+                    codegen=codegen, qssa=qssa, conserve=conserve,
+                    linear=linear, cache=cache,
+                    progress=verb > 0)
+                for i, res in enumerate(results):
+                    values[i] = np.concatenate(res)
+            else:
+                elapsed = np.zeros(len(idx))
+                results = run_pool(
+                    process_n_calc_2d, list(zip(line_dgs, line_s_dgs)), ncore,
+                    c0, df_network, tags, states, timeout, report_as_yield,
+                    quality, comp_ci, cost=cost, elapsed=elapsed,
+                    on_result=record, codegen=codegen, qssa=qssa,
+                    conserve=conserve, linear=linear, cache=cache,
+                    progress=verb > 0)
+                line_time[idx] = elapsed
+                for i, res in enumerate(results):
+                    values[i] = np.concatenate(res)
+            return values
+
+        def solve_line(idx):
+            values = resume_solve(solve_line_todo, line_ckpt, idx)
+            ci[idx] = values[:, n_target:]
+            return values[:, :n_target]
+
+        if adaptive:
+            prod_conc, solved = sample_line_adaptive(
+                solve_line, xint, adaptive)
+            if verb > 0:
+                print(f"Solved {solved.sum()} of {npoints} points")
+        else:
+            prod_conc = solve_line(np.arange(len(dgs)))
+        line_ckpt.close()
         # interpolation
         prod_conc_ = prod_conc.copy()
         ci_ = ci.copy()
@@ -1087,27 +2081,50 @@ I'll find happiness in abundance""")
         print(
             f"Performing microkinetics modelling for the volcano line ({len(d)})")
 
-        prod_conc_pt = np.zeros((len(d), n_target))
-
-        d_g = np.array_split(d, len(d) // ncore + 1)
-        i = 0
-        for batch_dgs in tqdm(d_g, total=len(d_g), ncols=80):
-            results = Parallel(
-                n_jobs=ncore)(
-                delayed(process_n_calc_2d)(
-                    profile,
-                    0,
-                    c0,
-                    df_network,
-                    tags,
-                    states,
-                    timeout,
-                    report_as_yield,
-                    quality,
-                    comp_ci) for profile in batch_dgs)
-            for j, res in enumerate(results):
-                prod_conc_pt[i, :] = res[0]
-                i += 1
+        # only new or changed catalysts are solved again; paired by name
+        # unless curate_d dropped incomplete profiles
+        pts_ckpt = Checkpoint(
+            ckpt_path, "volcano_points", len(d), n_target,
+            sweep_key(), resume, inputs=d,
+            labels=names if len(names) == len(d) else None)
+
+        def solve_points(idx):
+            prod = np.zeros((len(idx), n_target))
+            cost = tof_cost(d[idx], df_network, c0, tags, temperature)
+
+            def record(i, res):
+                pts_ckpt.write(idx[i], res[0])
+
+            if ensemble:
+                prod = calc_km_ensemble_batches(
+                    d[idx], ensemble, ncore, *ens_args, report_as_yield,
+                    quality, codegen=codegen, verb=verb, linear=linear)
+            elif warm_start:
+                # the catalysts along the descriptor axis
+                results = calc_warm_chains(
+                    process_n_calc_2d, [(profile, 0) for profile in d[idx]],
+                    ncore, c0, df_network, tags, states, timeout,
+                    report_as_yield, quality, comp_ci,
+                    order=np.argsort(X[idx]), cost=cost, on_result=record,
+                    codegen=codegen, qssa=qssa, conserve=conserve,
+                    linear=linear, cache=cache,
+                    progress=verb > 0)
+                for i, res in enumerate(results):
+                    prod[i, :] = res[0]
+            else:
+                results = run_pool(
+                    process_n_calc_2d, [(profile, 0) for profile in d[idx]],
+                    ncore, c0, df_network, tags, states, timeout,
+                    report_as_yield, quality, comp_ci, cost=cost,
+                    on_result=record, codegen=codegen, qssa=qssa,
+                    conserve=conserve, linear=linear, cache=cache,
+                    progress=verb > 0)
+                for i, res in enumerate(results):
+                    prod[i, :] = res[0]
+            return prod
+
+        prod_conc_pt = resume_solve(solve_points, pts_ckpt, np.arange(len(d)))
+        pts_ckpt.close()
 
         # interpolation
         missing_indices = np.isnan(prod_conc_pt[:, 0])
@@ -1211,78 +2228,278 @@ I'll find happiness in abundance""")
                 group.create_dataset('ylabel', data=[ylabel.encode()])
             out.append('data.h5')
 
-        if not os.path.isdir("output"):
-            os.makedirs("output")
+        if incremental:
+            # the previous output is updated, not moved aside
+            update_output(out, os.path.join(wdir, "output"))
             if lfesr:
-                shutil.move("lfesr", "output")
+                update_output(
+                    [os.path.join("lfesr", f) for f in os.listdir("lfesr")],
+                    os.path.join(wdir, "output", "lfesr"))
+                os.rmdir("lfesr")
+        else:
+            if not os.path.isdir("output"):
+                os.makedirs("output")
+                if lfesr:
+                    shutil.move("lfesr", "output")
+            else:
+                print("The output directort already exists")
+
+            for file_name in out:
+                source_file = os.path.abspath(file_name)
+                destination_file = os.path.join(
+                    "output/", os.path.basename(file_name))
+                shutil.move(source_file, destination_file)
+
+            if not os.path.isdir(os.path.join(wdir, "output/")):
+                shutil.move("output/", os.path.join(wdir, "output"))
+            else:
+                print("Output already exist")
+                move_bool = input("Move anyway? (y/n): ")
+                if move_bool == "y":
+                    shutil.move("output/", os.path.join(wdir, "output"))
+                elif move_bool == "n":
+                    pass
+                else:
+                    move_bool = input(
+                        f"{move_bool} is invalid, please try again... (y/n): ")
+
+        print("""\nI won't pray anymore
+The kindness that rained on this city
+I won't rely on it anymore
+My pain and my shape
+No one else can decide it\n""")
+
+    # %% energetic span volcano plot----------------------------------------------#
+    elif nd == 3:
+
+        if verb > 0:
+            print("\n------------Constructing energetic span volcano plot------------------\n")
+
+        layout = compile_profile(df_network, c0, tags)["layout"]
+        # volcano line and points in one pass
+        log_tof_all, es_all = calc_es_tof(
+            np.vstack([dgs, d]), layout, temperature)
+        log_tof, log_tof_pt = log_tof_all[:len(dgs)].T, log_tof_all[len(dgs):].T
+        es_pt = es_all[len(dgs):].T
+        cycle_names = [tags[cycle["dgr"] - 1] for cycle in layout]
+
+        if verb > 0:
+            print("\n-------------Energetic span (kcal/mol) and log10(TOF)-------------\n")
+            for i in np.argsort(-log_tof_pt[0]):
+                print(f"--{names[i]}: " + ", ".join(
+                    f"[{cycle_names[c]}] {es_pt[c, i]:.2f} / {log_tof_pt[c, i]:.2f}"
+                    for c in range(len(layout))) + "--")
+
+        xlabel = "$ΔG_{RRS}$" + f"({tag}) [kcal/mol]"
+        ylabel = "log(TOF) [1/s]"
+        y_base = 5
+
+        out = []
+        ci_ = np.full(log_tof.shape[0], None)
+        if log_tof.shape[0] > 1:
+            plot_2d_combo(
+                xint,
+                log_tof,
+                X,
+                log_tof_pt,
+                ci=ci_,
+                ms=ms,
+                xmin=xmin,
+                xmax=xmax,
+                ybase=y_base,
+                xlabel=xlabel,
+                ylabel=ylabel,
+                filename=f"es_volcano_{tag}_combo.png",
+                plotmode=plotmode,
+                labels=cycle_names)
+            out.append(f"es_volcano_{tag}_combo.png")
+            for i in range(log_tof.shape[0]):
+                plot_2d(
+                    xint,
+                    log_tof[i],
+                    X,
+                    log_tof_pt[i],
+                    ci=ci_[i],
+                    xmin=xmin,
+                    xmax=xmax,
+                    ybase=y_base,
+                    cb=cb,
+                    ms=ms,
+                    xlabel=xlabel,
+                    ylabel=ylabel,
+                    filename=f"es_volcano_{tag}_profile{i}.png",
+                    plotmode=plotmode)
+                out.append(f"es_volcano_{tag}_profile{i}.png")
+                plt.clf()
+        else:
+            plot_2d(
+                xint,
+                log_tof[0],
+                X,
+                log_tof_pt[0],
+                ci=ci_[0],
+                xmin=xmin,
+                xmax=xmax,
+                ybase=y_base,
+                cb=cb,
+                ms=ms,
+                xlabel=xlabel,
+                ylabel=ylabel,
+                filename=f"es_volcano_{tag}.png",
+                plotmode=plotmode)
+            out.append(f"es_volcano_{tag}.png")
+
+        if verb > 1:
+            data_dict = dict()
+            data_dict["entry"] = names
+            for c in range(len(layout)):
+                data_dict[f"ES_{cycle_names[c]}"] = es_pt[c]
+                data_dict[f"logTOF_{cycle_names[c]}"] = log_tof_pt[c]
+            pd.DataFrame(data_dict).to_csv('es_tof.csv', index=False)
+            out.append('es_tof.csv')
+
+            cb = np.array(cb, dtype='S')
+            ms = np.array(ms, dtype='S')
+            with h5py.File('data_es.h5', 'w') as f:
+                group = f.create_group('data')
+                # same layout as the MKM data.h5, with log10(TOF) as activity
+                group.create_dataset('descr_all', data=xint)
+                group.create_dataset('prod_conc_', data=log_tof)
+                group.create_dataset('descrp_pt', data=X)
+                group.create_dataset('prod_conc_pt_', data=log_tof_pt)
+                group.create_dataset('es_pt', data=es_pt)
+                group.create_dataset('cb', data=cb)
+                group.create_dataset('ms', data=ms)
+                group.create_dataset('tag', data=[tag.encode()])
+                group.create_dataset('xlabel', data=[xlabel.encode()])
+                group.create_dataset('ylabel', data=[ylabel.encode()])
+            out.append('data_es.h5')
+
+        if not os.path.isdir("output_es"):
+            os.makedirs("output_es")
+            if lfesr:
+                shutil.move("lfesr", "output_es")
         else:
             print("The output directort already exists")
 
         for file_name in out:
             source_file = os.path.abspath(file_name)
             destination_file = os.path.join(
-                "output/", os.path.basename(file_name))
+                "output_es/", os.path.basename(file_name))
             shutil.move(source_file, destination_file)
 
-        if not os.path.isdir(os.path.join(wdir, "output/")):
-            shutil.move("output/", os.path.join(wdir, "output"))
+        if not os.path.isdir(os.path.join(wdir, "output_es/")):
+            shutil.move("output_es/", os.path.join(wdir, "output_es"))
         else:
             print("Output already exist")
             move_bool = input("Move anyway? (y/n): ")
             if move_bool == "y":
-                shutil.move("output/", os.path.join(wdir, "output"))
+                shutil.move("output_es/", os.path.join(wdir, "output_es"))
             elif move_bool == "n":
                 pass
             else:
                 move_bool = input(
                     f"{move_bool} is invalid, please try again... (y/n): ")
 
-        print("""\nI won't pray anymore
-The kindness that rained on this city
-I won't rely on it anymore
-My pain and my shape
-No one else can decide it\n""")
-
     # %% MKM activity/selectivity map---------------------------------------------#
     elif nd == 2:
         if verb > 0:
             print(
                 "\n------------Constructing MKM activity/selectivity map------------------\n")
-        grid = np.zeros_like(gridj)
+        grid = np.zeros_like(grids[0])
         grid_d = np.array([grid] * n_target)
-        rb = np.zeros_like(gridj, dtype=int)
+        rb = np.zeros_like(grids[0], dtype=int)
         total_combinations = len(xint) * len(yint)
         combinations = list(
             itertools.product(
                 range(
                     len(xint)), range(
                     len(yint))))
-        num_chunks = total_combinations // ncore + \
-            (total_combinations % ncore > 0)
 
         # MKM
-        for chunk_index in tqdm(range(num_chunks)):
-            start_index = chunk_index * ncore
-            end_index = min(start_index + ncore, total_combinations)
-            chunk = combinations[start_index:end_index]
-
-            results = Parallel(
-                n_jobs=ncore)(
-                delayed(process_n_calc_3d)(
-                    coord,
-                    grids,
-                    c0,
-                    df_network,
-                    tags,
-                    states,
-                    timeout,
-                    report_as_yield,
-                    quality) for coord in chunk)
-            i = 0
-            for k, l in chunk:
-                for j in range(n_target):
-                    grid_d[j][k, l] = results[i][j]
-                i += 1
+        cell_time = np.full((len(xint), len(yint)), np.nan)
+        cell_idx = np.indices(cell_time.shape).reshape(2, -1).T
+
+        map_ckpt = Checkpoint(
+            ckpt_path, "map", total_combinations, n_target,
+            sweep_key(), resume,
+            inputs=np.reshape(grids, (len(grids), -1)).T, tol=tol)
+
+        def solve_cells(flat):
+            coords = list(zip(*np.unravel_index(flat, cell_time.shape)))
+            cells = np.zeros((len(coords), n_target))
+            profiles = np.array([[gridj[tuple(coord)] for gridj in grids]
+                                 for coord in coords])
+            # longest first: as the nearest cell of an earlier round, else
+            # by the TOF
+            cost = nearest_cost(cell_idx, cell_time.ravel(), coords)
+            if cost is None:
+                cost = tof_cost(profiles, df_network, c0, tags, temperature)
+            shared = shared_grid_d.open()
+
+            def record(i, res):
+                if res is None:
+                    # written to the shared grid_d by the worker
+                    res = shared[(slice(None),) + coords[i]]
+                map_ckpt.write(flat[i], res)
+
+            if ensemble:
+                cells = calc_km_ensemble_batches(
+                    profiles, ensemble, ncore, c0, df_network, tags, states,
+                    temperature, t_span, timeout, report_as_yield, quality,
+                    codegen=codegen, verb=verb, linear=linear)
+            elif warm_start:
+                # neighbouring cells follow each other along a serpentine path
+                path = np.argsort(serpentine(len(xint), len(yint)))
+                results = calc_warm_chains(
+                    process_n_calc_3d, [(coord,) for coord in coords],
+                    ncore, shared_grids, c0, df_network, tags, states, timeout,
+                    report_as_yield, quality,
+                    order=np.argsort(
+                        [path[k * len(yint) + l] for k, l in coords]),
+                    cost=cost, on_result=record, codegen=codegen, qssa=qssa,
+                    conserve=conserve, linear=linear, cache=cache,
+                    progress=verb > 0)
+                for i, res in enumerate(results):
+                    cells[i] = res
+            else:
+                # the workers write straight into the shared grid_d
+                elapsed = np.zeros(len(coords))
+                cell = (slice(None),) + tuple(np.asarray(coords).T)
+                run_pool(
+                    process_n_calc_3d, [(coord,) for coord in coords], ncore,
+                    shared_grids, c0, df_network, tags, states, timeout,
+                    report_as_yield, quality, cost=cost, elapsed=elapsed,
+                    out=shared_grid_d,
+                    out_index=[(slice(None), k, l) for k, l in coords],
+                    on_result=record, codegen=codegen, qssa=qssa,
+                    conserve=conserve, linear=linear, cache=cache,
+                    progress=verb > 0)
+                cell_time[cell[1:]] = elapsed
+                cells = np.array(shared[cell]).T
+            return cells
+
+        def solve_map(coords):
+            return resume_solve(
+                solve_cells, map_ckpt,
+                np.ravel_multi_index(np.asarray(coords).T, cell_time.shape))
+
+        # the regression grids and the results are published once in shared
+        # memory, the tasks only carry the cell
+        with shared_folder() as folder:
+            shared_grids = SharedArray(np.asarray(grids), folder, "grids")
+            shared_grid_d = SharedArray(grid_d, folder, "grid_d", mode="r+")
+            if adaptive:
+                grid_d, solved = refine_map_adaptive(
+                    solve_map, len(xint), len(yint), adaptive)
+                if verb > 0:
+                    print(f"Solved {solved.sum()} of {total_combinations} "
+                          "cells")
+            else:
+                results = solve_map(combinations)
+                grid_d[(slice(None),) + tuple(np.asarray(combinations).T)] = \
+                    results.T
+        map_ckpt.close()
 
         # TODO knn imputter for now
         if np.any(np.isnan(grid_d)):
@@ -0,0 +1,104 @@
+import hashlib
+import os
+
+import numpy as np
+from scipy import stats
+
+
+def design_matrix(*descriptors):
+    """[descriptor(s), 1] columns of a linear model."""
+    descriptors = [np.asarray(x, dtype=np.float64) for x in descriptors]
+    return np.stack(descriptors + [np.ones_like(descriptors[0])], axis=-1)
+
+
+def fit_lfesr(d, *descriptors):
+    """LFESRs of all states on the descriptor(s) as one least-squares fit.
+
+    Parameters
+    ----------
+    d : (n_profile, n_state) array
+        free energies
+    descriptors : (n_profile,) arrays
+        one (volcano) or two (map) descriptor variables
+
+    Returns
+    -------
+    coef : (n_descriptor + 1, n_state) array
+        slopes, then the intercept, of every state
+    resid : (n_profile, n_state) array
+    """
+    A = design_matrix(*descriptors)
+    d = np.asarray(d, dtype=np.float64)
+    coef = np.linalg.lstsq(A, d, rcond=None)[0]
+    return coef, d - A @ coef
+
+
+def predict_lfesr(coef, *grids):
+    """Energies of all states on the (mesh)grid of descriptor values.
+
+    Returns an (*grid shape, n_state) array, e.g. (npoints, n_state) for a
+    volcano line and (npoints, npoints, n_state) for a map.
+    """
+    mesh = np.meshgrid(*grids, indexing="ij")
+    return design_matrix(*mesh) @ coef
+
+
+def lfesr_ci(resid, descriptors, grids, level=0.95):
+    """Confidence band of predict_lfesr for all states at once.
+
+    t * s * sqrt(x0' (A'A)^-1 x0), which reduces to the calc_ci of
+    navicat_volcanic for a single descriptor.
+
+    Parameters
+    ----------
+    resid : (n_profile, n_state) array
+        from fit_lfesr
+    descriptors, grids : sequences of arrays
+        as passed to fit_lfesr and predict_lfesr
+
+    Returns
+    -------
+    ci : (*grid shape, n_state) array
+    """
+    A = design_matrix(*descriptors)
+    n, m = A.shape
+    dof = n - m
+    t = stats.t.ppf(level, dof)
+    s_err = np.sqrt(np.sum(resid ** 2, axis=0) / dof)
+    x0 = design_matrix(*np.meshgrid(*grids, indexing="ij"))
+    leverage = np.einsum("...i,ij,...j->...", x0, np.linalg.inv(A.T @ A), x0)
+    return t * np.sqrt(leverage)[..., None] * s_err
+
+
+def regression_key(filenames, *settings):
+    """Hash of the input files and the settings the regression depends on."""
+    sha = hashlib.sha1()
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            sha.update(hashlib.sha1(f.read()).digest())
+    sha.update(repr(settings).encode())
+    return sha.hexdigest()
+
+
+def save_regression(path, key, **products):
+    """Store the regression products (arrays, strings and numbers) of a run
+    for load_regression."""
+    arrays = {}
+    for name, value in products.items():
+        value = np.asarray(value)
+        # no pickles: object arrays (tags) are stored as strings
+        arrays[name] = value.astype(str) if value.dtype == object else value
+    tmp = f"{path}.tmp.npz"
+    np.savez(tmp, key=key, **arrays)
+    os.replace(tmp, path)
+
+
+def load_regression(path, key):
+    """The products of save_regression if stored with key, otherwise None."""
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if str(data["key"]) != key:
+                return None
+            return {name: data[name] for name in data.files if name != "key"}
+    except (OSError, ValueError, KeyError):
+        return None
@@ -0,0 +1,202 @@
+import numpy as np
+from scipy.optimize import OptimizeResult
+
+from qssa import split_species
+from rate_engine import compile_rxn_network
+
+# largest relative change of a species held fixed in the rate laws for the
+# pseudo-first-order solution to be accepted
+PFO_RTOL = 0.05
+
+_LINEAR = {}
+
+
+def compile_linear(network, fixed_idx=()):
+    """Add what calc_rate_matrix needs to a compiled network (in place).
+
+    The kinetics are linear if every side of every step has at most one
+    variable species, of order one. Species in ``fixed_idx`` enter the rate
+    laws with their initial concentration (pseudo-first-order) and only scale
+    the rate constants; their concentrations still follow the steps.
+
+    Raises
+    ------
+    ValueError
+        If the network is not (pseudo-)first order
+    """
+    n_species = network["n_species"]
+    fixed = np.zeros(n_species + 1, dtype=bool)
+    fixed[list(fixed_idx)] = True
+
+    cols = []
+    for side in (network["left"], network["right"]):
+        var = (side["idx"] < n_species) & ~fixed[side["idx"]]
+        if np.any(np.sum(var, axis=1) > 1) or np.any(side["order"][var] != 1):
+            raise ValueError("the network is not first order in the variable species")
+        # the extra slot of _compile_side (always 1.0) takes zero-order terms
+        cols.append(np.where(np.any(var, axis=1),
+                             side["idx"][np.arange(network["n_step"]),
+                                         np.argmax(var, axis=1)],
+                             n_species))
+
+    network["lin_col_f"], network["lin_col_r"] = cols
+    network["lin_fixed"] = fixed
+    return network
+
+
+def linear_network(rxn_network_all, states, pseudo_first_order=False):
+    """Compiled linear network, or None if the kinetics are not linear.
+
+    With ``pseudo_first_order`` the reactants (in large excess) and the
+    products (low conversion, no re-uptake) keep their initial concentrations
+    in the rate laws. Results are cached per network.
+    """
+    rxn_network_all = np.asarray(rxn_network_all, dtype=np.float64)
+    key = (rxn_network_all.tobytes(), rxn_network_all.shape,
+           tuple(states), pseudo_first_order)
+    if key not in _LINEAR:
+        network = compile_rxn_network(rxn_network_all)
+        fixed_idx = []
+        if pseudo_first_order:
+            _, fixed_idx = split_species(states)
+        try:
+            _LINEAR[key] = compile_linear(network, fixed_idx)
+        except ValueError:
+            _LINEAR[key] = None
+    return _LINEAR[key]
+
+
+def calc_rate_matrix(k_forward_all, k_reverse_all, network, initial_conc):
+    """Rate matrix A of the linear system, d[y, 1]/dt = A [y, 1].
+
+    The last row and column carry the zero-order terms. Batched rate
+    constants (..., n_step) give (..., n_species + 1, n_species + 1).
+    """
+    n_species = network["n_species"]
+    n_step = network["n_step"]
+    c = np.ones(n_species + 1)
+    fixed = network["lin_fixed"]
+    c[fixed] = np.asarray(initial_conc)[fixed[:n_species]]
+
+    k_forward_all = np.asarray(k_forward_all, dtype=np.float64)
+    k_reverse_all = np.asarray(k_reverse_all, dtype=np.float64)
+    # the variable species have order one, so their entries multiply by 1
+    left, right = network["left"], network["right"]
+    c_f = np.where(fixed[left["idx"]], c[left["idx"]] ** left["order"], 1)
+    c_r = np.where(fixed[right["idx"]], c[right["idx"]] ** right["order"], 1)
+
+    steps = np.arange(n_step)
+    drate = np.zeros(k_forward_all.shape[:-1] + (n_step, n_species + 1))
+    drate[..., steps, network["lin_col_f"]] = \
+        k_forward_all * np.prod(c_f, axis=-1)
+    drate[..., steps, network["lin_col_r"]] -= \
+        k_reverse_all * np.prod(c_r, axis=-1)
+
+    A = np.zeros(k_forward_all.shape[:-1] + (n_species + 1, n_species + 1))
+    A[..., :n_species, :] = np.matmul(network["stoich"], drate)
+    return A
+
+
+def solve_linear(k_forward_all, k_reverse_all, network, initial_conc, t_eval):
+    """Concentrations of a linear network at the times t_eval.
+
+    The species that enter the rate laws follow x' = Q x + b, solved in
+    closed form from the eigendecomposition of Q; all other species (sinks,
+    fixed species) are the exact time integral of their rates. Evaluated for
+    all times (and all sets of rate constants if batched) at once.
+
+    expm(A t) itself cannot be used: for steps with k ~ 1e13 s-1 over a day,
+    scaling and squaring amplifies rounding in the catalyst total by orders
+    of magnitude. Eigenvalues are only resolved down to eps * |Q|; below
+    that they are taken as zero (Q is compartmental, Re(lambda) <= 0).
+
+    Returns
+    -------
+    result : OptimizeResult
+        t, y (..., n_species, n_t), success, status and message, like the
+        result of solve_ivp; y is NaN for the members with non-finite rate
+        constants or a (nearly) defective Q, and success is False then
+    """
+    n_species = network["n_species"]
+    t_eval = np.asarray(t_eval, dtype=np.float64)
+    initial_conc = np.asarray(initial_conc, dtype=np.float64)
+    A = calc_rate_matrix(k_forward_all, k_reverse_all, network, initial_conc)
+    batch = A.shape[:-2]
+    valid = np.all(np.isfinite(A), axis=(-2, -1))
+    A = np.where(valid[..., None, None], A, 0)
+
+    used = np.union1d(network["lin_col_f"], network["lin_col_r"])
+    act = used[used < n_species]
+    pas = np.setdiff1d(np.arange(n_species), act)
+    y = np.empty(batch + (n_species, t_eval.size))
+
+    if act.size:
+        Q = A[..., act[:, None], act]
+        b = A[..., act, n_species]
+        lam, V = np.linalg.eig(Q)
+        valid &= np.linalg.cond(V) < 1 / np.sqrt(np.finfo(np.float64).eps)
+        V = np.where(valid[..., None, None], V, np.eye(act.size))
+        tiny = act.size * np.finfo(np.float64).eps * \
+            np.max(np.abs(Q), axis=(-2, -1), initial=0)
+        lam = np.where(np.abs(lam) <= tiny[..., None], 0,
+                       np.minimum(lam.real, 0) + 1j * lam.imag)
+
+        # phi1 = (e^z - 1)/lam and phi2 = (e^z - 1 - z)/lam^2 with z = lam t
+        z = lam[..., None, :] * t_eval[:, None]
+        lam_ = np.where(lam == 0, 1, lam)[..., None, :]
+        small = np.abs(z) < 1e-3
+        t_ = t_eval[:, None]
+        with np.errstate(invalid="ignore", over="ignore"):
+            phi1 = np.where(small, t_ * (1 + z / 2 + z * z / 6), np.expm1(z) / lam_)
+            phi2 = np.where(small, t_ * t_ / 2 * (1 + z / 3 + z * z / 12),
+                            (np.expm1(z) - z) / lam_ ** 2)
+        x0 = np.broadcast_to(initial_conc[act], batch + (act.size,))
+        a = np.linalg.solve(V, x0[..., None] + 0j)[..., None, :, 0]
+        beta = np.linalg.solve(V, b[..., None] + 0j)[..., None, :, 0]
+        x = np.einsum('...ij,...tj->...it', V, np.exp(z) * a + phi1 * beta)
+        X = np.einsum('...ij,...tj->...it', V, phi1 * a + phi2 * beta)
+        y[..., act, :] = x.real
+    else:
+        X = np.zeros(batch + (0, t_eval.size))
+
+    y[..., pas, :] = initial_conc[pas, None] + \
+        np.matmul(A[..., pas[:, None], act], X.real) + \
+        A[..., pas, n_species][..., None] * t_eval
+    y[~valid] = np.nan
+    success = bool(np.all(np.isfinite(y)))
+    return OptimizeResult(
+        t=t_eval,
+        y=y,
+        success=success,
+        status=0 if success else -1,
+        message="Closed-form solution evaluated." if success
+        else "Non-finite or (nearly) defective rate matrix.",
+        nfev=0,
+        njev=0)
+
+
+def time_grid(t_span, n_t=200):
+    """Sampling times for the closed-form solution, log-spaced like the
+    steps of a stiff integrator (the start is kept for plotting)."""
+    t0, t1 = t_span
+    return np.concatenate(
+        [[t0], t0 + np.geomspace((t1 - t0) * 1e-15, t1 - t0, n_t - 1)])
+
+
+def linear_ok(y, network, initial_conc, rtol=PFO_RTOL):
+    """Members of a (batched) closed-form solution that can be accepted.
+
+    The final state has to be finite and non-negative (to rtol of the largest
+    initial concentration), and the species held fixed in the rate laws must
+    not have moved by more than rtol of their initial concentration.
+    """
+    initial_conc = np.asarray(initial_conc, dtype=np.float64)
+    y_final = y[..., -1]
+    ok = np.all(np.isfinite(y_final), axis=-1)
+    y_final = np.where(ok[..., None], y_final, 0)
+    ok &= np.min(y_final, axis=-1) >= -rtol * np.max(initial_conc)
+    fixed = network["lin_fixed"][:-1] & (initial_conc > 0)
+    if np.any(fixed):
+        drift = np.abs(y_final[..., fixed] - initial_conc[fixed])
+        ok &= np.all(drift <= rtol * initial_conc[fixed], axis=-1)
+    return ok
@@ -0,0 +1,182 @@
+import hashlib
+import importlib.util
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# bump when the generated source changes so stale cache files are ignored
+CODEGEN_VERSION = 1
+
+_KERNELS = {}
+
+
+def kernel_cache_dir():
+    """Directory of the on-disk kernel cache ($SPECTRE_CACHE or ~/.cache/spectre)."""
+    root = os.environ.get(
+        "SPECTRE_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "spectre"))
+    return os.path.join(root, "kernels")
+
+
+def network_hash(rxn_network_all, states):
+    """Hash identifying the topology (and species names) of a network."""
+    rxn_network_all = np.ascontiguousarray(rxn_network_all, dtype=np.float64)
+    sha = hashlib.sha1()
+    sha.update(f"v{CODEGEN_VERSION}".encode())
+    sha.update(str(rxn_network_all.shape).encode())
+    sha.update(rxn_network_all.tobytes())
+    sha.update("\x00".join(str(s) for s in states).encode())
+    return sha.hexdigest()[:16]
+
+
+def _factor(j, o):
+    if o == 1:
+        return f"y[{j}]"
+    if o == 2:
+        return f"y[{j}] * y[{j}]"
+    return f"y[{j}] ** {o!r}"
+
+
+def _dfactor(j, o):
+    if o == 1:
+        return None
+    if o == 2:
+        return f"2.0 * y[{j}]"
+    return f"{o!r} * y[{j}] ** {o - 1!r}"
+
+
+def _product(k, factors):
+    return " * ".join([k] + [f for f in factors if f is not None])
+
+
+def _signed_sum(terms):
+    """Join (sign, expr) pairs into one expression, '0.0' if empty."""
+    expr = ""
+    for sign, term in terms:
+        if not expr:
+            expr = term if sign > 0 else f"-{term}"
+        else:
+            expr += f" + {term}" if sign > 0 else f" - {term}"
+    return expr or "0.0"
+
+
+def generate_kernel_source(rxn_network_all, states):
+    """Straight-line Python source for dy/dt and the Jacobian of a network.
+
+    The module defines ``dydt(y, kf, kr)``, ``jac(y, kf, kr)`` (dense) and
+    ``jac_data(y, kf, kr)``, the non-zeros of the Jacobian in the CSC order
+    given by ``JAC_INDICES``/``JAC_INDPTR``.
+    """
+    rxn_network_all = np.array(rxn_network_all, dtype=np.float64)
+    n_step, n_species = rxn_network_all.shape
+    sides = []
+    for a in range(n_step):
+        left = [(j, float(-rxn_network_all[a, j]))
+                for j in np.where(rxn_network_all[a, :] < 0)[0]]
+        right = [(j, float(rxn_network_all[a, j]))
+                 for j in np.where(rxn_network_all[a, :] > 0)[0]]
+        sides.append((left, right))
+
+    lines = [
+        "# generated by spectre.network_codegen, do not edit",
+        f"# species: {', '.join(str(s) for s in states)}",
+        "import numpy as np",
+        "",
+        f"N_SPECIES = {n_species}",
+        f"N_STEP = {n_step}",
+        "",
+        "",
+        "def dydt(y, kf, kr):",
+    ]
+    for a, (left, right) in enumerate(sides):
+        forward = _product(f"kf[{a}]", [_factor(j, o) for j, o in left])
+        reverse = _product(f"kr[{a}]", [_factor(j, o) for j, o in right])
+        lines.append(f"    r{a} = {forward} - {reverse}")
+    lines.append(f"    out = np.empty({n_species})")
+    for i in range(n_species):
+        terms = [(np.sign(rxn_network_all[a, i]), f"r{a}")
+                 for a in range(n_step) if rxn_network_all[a, i] != 0]
+        lines.append(f"    out[{i}] = {_signed_sum(terms)}")
+    lines += ["    return out", ""]
+
+    # d(rate_a)/dy_j for every species j in the rate law of step a
+    derivs = []
+    coupling = {}
+    for a, (left, right) in enumerate(sides):
+        for k, sign, side in ((f"kf[{a}]", 1, left), (f"kr[{a}]", -1, right)):
+            for m, (j, o) in enumerate(side):
+                others = [_factor(jj, oo)
+                          for mm, (jj, oo) in enumerate(side) if mm != m]
+                expr = _product(k, [_dfactor(j, o)] + others)
+                name = f"d{a}_{j}"
+                derivs.append(f"    {name} = {expr if sign > 0 else '-' + expr}")
+                for i in np.where(rxn_network_all[a, :] != 0)[0]:
+                    coupling.setdefault((j, i), []).append(
+                        (np.sign(rxn_network_all[a, i]), name))
+
+    # CSC order: by column (j), then row (i)
+    nonzeros = sorted(coupling)
+    indices = [i for j, i in nonzeros]
+    indptr = np.searchsorted([j for j, i in nonzeros],
+                             np.arange(n_species + 1)).tolist()
+    lines.insert(6, f"JAC_INDICES = np.array({indices})")
+    lines.insert(7, f"JAC_INDPTR = np.array({indptr})")
+
+    lines += ["", "def jac(y, kf, kr):"] + derivs
+    lines.append(f"    J = np.zeros(({n_species}, {n_species}))")
+    for j, i in nonzeros:
+        lines.append(f"    J[{i}, {j}] = {_signed_sum(coupling[(j, i)])}")
+    lines += ["    return J", ""]
+
+    lines += ["", "def jac_data(y, kf, kr):"] + derivs
+    lines.append(f"    out = np.empty({len(nonzeros)})")
+    for n, (j, i) in enumerate(nonzeros):
+        lines.append(f"    out[{n}] = {_signed_sum(coupling[(j, i)])}")
+    lines += ["    return out", ""]
+
+    return "\n".join(lines)
+
+
+def load_kernels(rxn_network_all, states, use_numba=True):
+    """Generated kernels for a network, from memory, the disk cache or fresh.
+
+    Returns a module-like object with ``dydt``, ``jac``, ``jac_data``,
+    ``JAC_INDICES`` and ``JAC_INDPTR``. With numba installed (and
+    ``use_numba``), the three functions are JIT-compiled with an on-disk
+    cache next to the generated source.
+    """
+    key = network_hash(rxn_network_all, states)
+    use_numba = use_numba and njit is not None
+    if (key, use_numba) in _KERNELS:
+        return _KERNELS[(key, use_numba)]
+
+    cache_dir = kernel_cache_dir()
+    path = os.path.join(cache_dir, f"kernel_{key}.py")
+    if not os.path.isfile(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        source = generate_kernel_source(rxn_network_all, states)
+        # write then rename, so concurrent workers never see half a file
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".py")
+        with os.fdopen(fd, "w") as f:
+            f.write(source)
+        os.replace(tmp, path)
+
+    spec = importlib.util.spec_from_file_location(f"kernel_{key}", path)
+    module = importlib.util.module_from_spec(spec)
+    # numba's cache resolves the kernels' globals through sys.modules
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+
+    if use_numba:
+        for name in ("dydt", "jac", "jac_data"):
+            setattr(module, name, njit(cache=True)(getattr(module, name)))
+
+    _KERNELS[(key, use_numba)] = module
+    return module
@@ -0,0 +1,198 @@
+import numpy as np
+from scipy.linalg import null_space
+
+from rate_engine import calc_jac, calc_mass_action
+
+
+def split_species(states):
+    """Indices of the catalyst states and of the reactants/products.
+
+    Species named R*/P* (without INT) are reactants/products; everything else,
+    including the free catalyst in the first column, is a catalyst state.
+    """
+    R_idx = [i for i, s in enumerate(
+        states) if s.lower().startswith('r') and 'INT' not in s]
+    P_idx = [i for i, s in enumerate(
+        states) if s.lower().startswith('p') and 'INT' not in s]
+    slow_idx = sorted(R_idx + P_idx)
+    cat_idx = [i for i in range(len(states)) if i not in slow_idx]
+    return np.array(cat_idx, dtype=int), np.array(slow_idx, dtype=int)
+
+
+def compile_qssa(network, states):
+    """Add what the QSSA reduction needs to a compiled network (in place).
+
+    The reduction requires the rates to be linear in the catalyst states:
+    at most one catalyst state, of order one, on each side of a step, and
+    exactly one on each side of a step that converts catalyst states.
+
+    Raises
+    ------
+    ValueError
+        If the network is not linear in the catalyst states
+    """
+    n_species = network["n_species"]
+    cat_idx, slow_idx = split_species(states)
+    if cat_idx.size == 0 or slow_idx.size == 0:
+        raise ValueError("QSSA needs both catalyst states and reactants/products")
+    is_cat = np.zeros(n_species + 1, dtype=bool)
+    is_cat[cat_idx] = True
+    position = np.zeros(n_species + 1, dtype=int)
+    position[cat_idx] = np.arange(cat_idx.size)
+
+    onehot = []
+    for side in (network["left"], network["right"]):
+        cat = is_cat[side["idx"]]
+        if np.any(np.sum(cat, axis=1) > 1) or np.any(side["order"][cat] != 1):
+            raise ValueError(
+                "QSSA needs every step to be first order in the catalyst states")
+        indicator = np.zeros((network["n_step"], cat_idx.size))
+        rows, cols = np.where(cat)
+        indicator[rows, position[side["idx"][rows, cols]]] = 1
+        onehot.append(indicator)
+
+    converts = np.any(network["stoich"][cat_idx] != 0, axis=0)
+    if np.any(onehot[0][converts].sum(axis=1) != 1) or \
+            np.any(onehot[1][converts].sum(axis=1) != 1):
+        raise ValueError(
+            "QSSA needs steps that change the catalyst states to conserve them")
+
+    # scatter of the pseudo-first-order constants of every step into the
+    # (from, to) transition rates between catalyst states, as flat indices
+    n_cat = cat_idx.size
+    origin = np.argmax(onehot[0], axis=1)
+    target = np.argmax(onehot[1], axis=1)
+    scatter_f = np.zeros((n_cat * n_cat, network["n_step"]))
+    scatter_r = np.zeros((n_cat * n_cat, network["n_step"]))
+    steps = np.where(converts)[0]
+    scatter_f[origin[steps] * n_cat + target[steps], steps] = 1
+    scatter_r[target[steps] * n_cat + origin[steps], steps] = 1
+
+    network["cat_idx"] = cat_idx
+    network["slow_idx"] = slow_idx
+    network["cat_steps"] = steps
+    network["cat_scatter_f"] = scatter_f
+    network["cat_scatter_r"] = scatter_r
+    # combinations of converting steps that keep every catalyst state steady
+    network["cat_cycles"] = null_space(
+        network["stoich"][np.ix_(cat_idx, steps)])
+    return network
+
+
+def stationary_distribution(rates):
+    """Stationary distribution of a Markov chain from its transition rates.
+
+    ``rates[i, j]`` is the rate constant from state i to state j (the
+    diagonal is ignored). The GTH elimination (Grassmann, Taksar and Heyman)
+    involves no subtractions, so even very small populations come out with
+    full relative accuracy, unlike with a dense linear solve.
+    """
+    P = np.array(rates, dtype=np.float64)
+    n = P.shape[0]
+    for k in range(n - 1, 0, -1):
+        out = np.sum(P[k, :k])
+        if not out > 0:
+            raise np.linalg.LinAlgError("catalyst states are not connected")
+        P[:k, k] /= out
+        P[:k, :k] += np.outer(P[:k, k], P[k, :k])
+    x = np.zeros(n)
+    x[0] = 1
+    for j in range(1, n):
+        x[j] = np.dot(x[:j], P[:j, j])
+    return x / np.sum(x)
+
+
+def qssa_catalyst(z, k_forward_all, k_reverse_all, network, cat_total):
+    """Steady-state catalyst states for reactant/product concentrations z.
+
+    For fixed z the catalyst states form a Markov chain with pseudo-first-order
+    rate constants; its stationary distribution is scaled to the total
+    catalyst.
+    """
+    y = np.ones(network["n_species"])
+    y[network["slow_idx"]] = z
+    # catalyst entries are 1, so these are the pseudo-first-order constants
+    forward, reverse = calc_mass_action(y, network)
+    n_cat = network["cat_idx"].size
+    rates = np.dot(network["cat_scatter_f"], k_forward_all * forward) + \
+        np.dot(network["cat_scatter_r"], k_reverse_all * reverse)
+    return cat_total * stationary_distribution(rates.reshape(n_cat, n_cat))
+
+
+def qssa_rates(y, k_forward_all, k_reverse_all, network):
+    """Net rate of every step with the catalyst states in QSS.
+
+    Forward minus reverse loses all accuracy for fast steps close to
+    equilibrium, so the rates of the catalyst-converting steps are taken as
+    the combination of catalytic cycles that best matches the directly
+    computed rates, each weighted by its accuracy (inverse gross flux).
+    """
+    forward, reverse = calc_mass_action(y, network)
+    forward = k_forward_all * forward
+    reverse = k_reverse_all * reverse
+    rates = forward - reverse
+
+    steps = network["cat_steps"]
+    cycles = network["cat_cycles"]
+    gross = forward[steps] + reverse[steps]
+    if cycles.shape[1] == 0 or not np.max(gross) > 0:
+        rates[steps] = 0
+        return rates
+    weight = 1 / np.maximum(gross, np.finfo(np.float64).eps * np.max(gross))
+    w = np.linalg.lstsq(
+        cycles * weight[:, None], rates[steps] * weight, rcond=None)[0]
+    rates[steps] = np.dot(cycles, w)
+    return rates
+
+
+def qssa_system(k_forward_all, k_reverse_all, network, states, initial_conc):
+    """Reduced ODE for the reactants/products with catalyst states in QSS.
+
+    Returns a ``dydt(t, z)`` in the reactant/product concentrations with the
+    same attributes as the one of system_KE_DE (``jac``, ``jac_sparsity``,
+    ``network``) plus ``state_idx``, the species integrated, and ``expand``,
+    which rebuilds full concentrations (n_species, n_t) from z (n_slow, n_t).
+    """
+    compile_qssa(network, states)
+    cat_idx = network["cat_idx"]
+    slow_idx = network["slow_idx"]
+    cat_total = np.sum(np.asarray(initial_conc)[cat_idx])
+    stoich_slow = network["stoich"][slow_idx]
+    y = np.zeros(network["n_species"])
+
+    def _full(z):
+        y[cat_idx] = qssa_catalyst(
+            z, k_forward_all, k_reverse_all, network, cat_total)
+        y[slow_idx] = z
+        return y
+
+    def _dydt(t, z):
+        return np.dot(stoich_slow, qssa_rates(
+            _full(z), k_forward_all, k_reverse_all, network))
+
+    def _jac(t, z):
+        J = calc_jac(_full(z), k_forward_all, k_reverse_all, network)
+        # implicit differentiation of the catalyst balances with one of them
+        # replaced by the conservation of the total catalyst
+        M = J[np.ix_(cat_idx, cat_idx)]
+        M[0, :] = 1
+        B = J[np.ix_(cat_idx, slow_idx)]
+        B[0, :] = 0
+        dx_dz = -np.linalg.solve(M, B)
+        return J[np.ix_(slow_idx, slow_idx)] + \
+            np.dot(J[np.ix_(slow_idx, cat_idx)], dx_dz)
+
+    def _expand(z):
+        z = np.asarray(z)
+        y_all = np.zeros((network["n_species"], z.shape[1]))
+        for i in range(z.shape[1]):
+            y_all[:, i] = _full(z[:, i])
+        return y_all
+
+    _dydt.jac = _jac
+    _dydt.jac_sparsity = None
+    _dydt.network = network
+    _dydt.state_idx = slow_idx
+    _dydt.expand = _expand
+
+    return _dydt
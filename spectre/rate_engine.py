@@ -0,0 +1,205 @@
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix
+
+# networks with at least this many species get a sparse analytic Jacobian
+SPARSE_JAC_MIN_SPECIES = 50
+
+
+def _compile_side(order_matrix):
+    """Gather indices and orders for one side (left or right) of every step.
+
+    Rows are padded to the same width with the index of an extra species
+    slot that always holds 1.0, so padded entries do not change the product.
+    """
+    n_step, n_species = order_matrix.shape
+    width = int(np.max(np.count_nonzero(order_matrix, axis=1), initial=0))
+    idx = np.full((n_step, width), n_species, dtype=int)
+    order = np.ones((n_step, width))
+    for a in range(n_step):
+        loc = np.where(order_matrix[a, :] != 0)[0]
+        idx[a, :loc.size] = loc
+        order[a, :loc.size] = order_matrix[a, loc]
+
+    sq = order == 2
+    gen = (order != 1) & (order != 2)
+    return {
+        "idx": idx,
+        "order": order,
+        "sq": sq,
+        "gen": gen,
+        "has_sq": bool(np.any(sq)),
+        "has_gen": bool(np.any(gen)),
+    }
+
+
+def compile_rxn_network(rxn_network_all):
+    """Pre-extract everything needed to evaluate mass-action rates.
+
+    Parameters
+    ----------
+    rxn_network_all : array-like
+        Reaction network matrix (steps x species), negative for the species
+        consumed and positive for the species formed in each step.
+
+    Returns
+    -------
+    network : dict
+        stoich : (n_species, n_step) sign matrix used to assemble dy/dt
+        left, right : gather indices and integer orders of each side
+        steps : (n_step, 1) row indices used to scatter rate derivatives
+        sparsity : (n_species, n_species) boolean Jacobian pattern, usable
+            as ``jac_sparsity`` in solve_ivp
+    """
+    rxn_network_all = np.array(rxn_network_all, dtype=np.float64)
+    n_step, n_species = rxn_network_all.shape
+    stoich = np.sign(rxn_network_all).T
+
+    # species i is coupled to species j if a step changing i has j in its rate
+    sparsity = np.dot(np.abs(stoich), rxn_network_all != 0) > 0
+
+    return {
+        "n_step": n_step,
+        "n_species": n_species,
+        "steps": np.arange(n_step)[:, None],
+        "stoich": stoich,
+        "sparsity": sparsity,
+        "left": _compile_side(np.where(rxn_network_all < 0, -rxn_network_all, 0)),
+        "right": _compile_side(np.where(rxn_network_all > 0, rxn_network_all, 0)),
+    }
+
+
+def _extend(y):
+    """Append the constant 1.0 slot that padded gather indices point to."""
+    return np.concatenate([y, np.ones(y.shape[:-1] + (1,))], axis=-1)
+
+
+def _mass_action(y_ext, side):
+
+    c = y_ext[..., side["idx"]]
+    if side["has_sq"]:
+        c = np.where(side["sq"], c * c, c)
+    if side["has_gen"]:
+        c = np.where(side["gen"], c ** side["order"], c)
+    return np.prod(c, axis=-1)
+
+
+def calc_mass_action(y, network):
+    """Concentration products of the left and right side of every step."""
+    y_ext = _extend(y)
+    return _mass_action(y_ext, network["left"]), \
+        _mass_action(y_ext, network["right"])
+
+
+def calc_rates(y, k_forward_all, k_reverse_all, network):
+    """Net rate of every elementary step (forward minus reverse).
+
+    ``y`` may carry leading batch dimensions, (..., n_species), with rate
+    constants of matching shape (..., n_step).
+    """
+    forward, reverse = calc_mass_action(y, network)
+    return k_forward_all * forward - k_reverse_all * reverse
+
+
+def calc_dydt(y, k_forward_all, k_reverse_all, network):
+    """Time derivative of all species concentrations."""
+    rates = calc_rates(y, k_forward_all, k_reverse_all, network)
+    return np.dot(rates, network["stoich"].T)
+
+
+def _mass_action_partials(y_ext, side):
+    """Derivative of every mass-action term with respect to each of its factors.
+
+    Products of the other factors come from prefix/suffix cumulative products
+    so that zero concentrations never end up in a denominator.
+    """
+    y = y_ext[..., side["idx"]]
+    c = y
+    dc = np.ones_like(y)
+    if side["has_sq"]:
+        c = np.where(side["sq"], y * y, c)
+        dc = np.where(side["sq"], 2 * y, dc)
+    if side["has_gen"]:
+        c = np.where(side["gen"], y ** side["order"], c)
+        dc = np.where(side["gen"], side["order"] *
+                      y ** (side["order"] - 1), dc)
+
+    ones = np.ones(c.shape[:-1] + (1,))
+    prefix = np.cumprod(np.concatenate([ones, c[..., :-1]], axis=-1), axis=-1)
+    suffix = np.cumprod(np.concatenate(
+        [ones, c[..., :0:-1]], axis=-1), axis=-1)[..., ::-1]
+    return prefix * suffix * dc
+
+
+def calc_jac(y, k_forward_all, k_reverse_all, network):
+    """Analytic Jacobian d(dy/dt)/dy of the mass-action system.
+
+    Batched inputs (..., n_species) give (..., n_species, n_species).
+    """
+    y_ext = _extend(y)
+    left = network["left"]
+    right = network["right"]
+
+    # d(rate)/dy, with the extra column collecting the padded entries
+    drate_dy = np.zeros(
+        y.shape[:-1] + (network["n_step"], network["n_species"] + 1))
+    drate_dy[..., network["steps"], left["idx"]] = \
+        k_forward_all[..., None] * _mass_action_partials(y_ext, left)
+    drate_dy[..., network["steps"], right["idx"]] = \
+        -k_reverse_all[..., None] * _mass_action_partials(y_ext, right)
+
+    return np.matmul(network["stoich"], drate_dy[..., :-1])
+
+
+def compile_sparse_jac(network):
+    """Add what calc_jac_sparse needs to a compiled network (in place).
+
+    Every non-zero of the Jacobian is a signed sum of rate derivatives, so the
+    mapping from the d(rate)/dy entries to the CSC data of the Jacobian is
+    stored once as a sparse matrix.
+    """
+    n_species = network["n_species"]
+    pattern = csc_matrix(network["sparsity"])
+    pattern.sort_indices()
+    position = np.full((n_species, n_species), -1, dtype=int)
+    cols = np.repeat(np.arange(n_species), np.diff(pattern.indptr))
+    position[pattern.indices, cols] = np.arange(pattern.nnz)
+
+    valid = []
+    rows_map, cols_map, vals_map = [], [], []
+    offset = 0
+    for side in (network["left"], network["right"]):
+        mask = side["idx"] < n_species
+        steps = np.broadcast_to(network["steps"], mask.shape)[mask]
+        species = side["idx"][mask]
+        for e, (a, j) in enumerate(zip(steps, species)):
+            changed = np.where(network["stoich"][:, a] != 0)[0]
+            rows_map.extend(position[changed, j])
+            cols_map.extend([offset + e] * changed.size)
+            vals_map.extend(network["stoich"][changed, a])
+        valid.append(mask)
+        offset += species.size
+
+    network["jac_map"] = csr_matrix(
+        (vals_map, (rows_map, cols_map)), shape=(pattern.nnz, offset))
+    network["jac_indices"] = pattern.indices
+    network["jac_indptr"] = pattern.indptr
+    network["left"]["valid"], network["right"]["valid"] = valid
+    return network
+
+
+def calc_jac_sparse(y, k_forward_all, k_reverse_all, network):
+    """Analytic Jacobian as a CSC matrix, for sparse LU in BDF/Radau."""
+    y_ext = _extend(y)
+    left = network["left"]
+    right = network["right"]
+
+    drate_l = k_forward_all[:, None] * _mass_action_partials(y_ext, left)
+    drate_r = -k_reverse_all[:, None] * _mass_action_partials(y_ext, right)
+    drate = np.concatenate([drate_l[left["valid"]], drate_r[right["valid"]]])
+
+    n = network["n_species"]
+    return csc_matrix(
+        (network["jac_map"].dot(drate),
+         network["jac_indices"],
+         network["jac_indptr"]),
+        shape=(n, n))
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from network_codegen import network_hash
+
+# energies are keyed to this many decimals (kcal/mol)
+DECIMALS = 6
+MAX_MEMORY_ENTRIES = 2 ** 16
+MAX_DISK_BYTES = 2 ** 28
+
+_CACHES = {}
+
+
+def result_cache_path():
+    """On-disk result cache ($SPECTRE_CACHE or ~/.cache/spectre)."""
+    root = os.environ.get(
+        "SPECTRE_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "spectre"))
+    return os.path.join(root, "results.sqlite")
+
+
+def result_key(rxn_network_all, states, energy_profile_all, dgr_all,
+               coeff_TS_all, conditions):
+    """Hash of an MKM problem: the network, the rounded energies of its
+    cycles and the conditions/solver settings (a tuple of plain values or
+    arrays)."""
+    sha = hashlib.sha1()
+    sha.update(network_hash(rxn_network_all, states).encode())
+    for energies in (*energy_profile_all, *dgr_all):
+        # + 0.0 so that -0.0 and 0.0 hash alike
+        energies = np.round(np.asarray(energies, dtype=np.float64),
+                            DECIMALS) + 0.0
+        sha.update(energies.tobytes())
+        sha.update(b"\x00")
+    for coeff_TS in coeff_TS_all:
+        sha.update(np.asarray(coeff_TS, dtype=np.int64).tobytes())
+        sha.update(b"\x00")
+    for part in conditions:
+        if isinstance(part, np.ndarray):
+            sha.update(np.ascontiguousarray(part, dtype=np.float64).tobytes())
+        else:
+            sha.update(repr(part).encode())
+        sha.update(b"\x00")
+    return sha.hexdigest()
+
+
+class ResultCache:
+    """Results of MKM solves: an in-process LRU in front of a SQLite file.
+
+    The file is shared by all processes and runs; the least recently used
+    results are evicted once it holds more than ``max_bytes`` of them.
+    """
+
+    def __init__(self, path, max_entries=MAX_MEMORY_ENTRIES,
+                 max_bytes=MAX_DISK_BYTES):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.memory = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # a lost result is only solved again, no need to sync every write
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS results "
+                        "(key TEXT PRIMARY KEY, value BLOB, used REAL)")
+        self._puts = 0
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """The cached result of key (a copy), None if there is none."""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key].copy()
+        row = self.db.execute("SELECT value FROM results WHERE key = ?",
+                              (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE results SET used = ? WHERE key = ?",
+                        (time.time(), key))
+        value = np.frombuffer(row[0], dtype=np.float64).copy()
+        self._remember(key, value)
+        return value.copy()
+
+    def put(self, key, value):
+        value = np.array(value, dtype=np.float64).ravel()
+        self._remember(key, value)
+        self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                        (key, value.tobytes(), time.time()))
+        self._puts += 1
+        if self._puts % 256 == 0:
+            self.evict()
+
+    def evict(self):
+        """Drop the least recently used results beyond max_bytes."""
+        count, size = self.db.execute(
+            "SELECT COUNT(*), SUM(LENGTH(value) + LENGTH(key)) "
+            "FROM results").fetchone()
+        if not count or size <= self.max_bytes:
+            return
+        n_drop = int(np.ceil(count * (1 - self.max_bytes / size)))
+        self.db.execute("DELETE FROM results WHERE key IN (SELECT key FROM "
+                        "results ORDER BY used LIMIT ?)", (n_drop,))
+
+
+def get_result_cache(path):
+    """The ResultCache of path for this process."""
+    if path not in _CACHES:
+        _CACHES[path] = ResultCache(path)
+    return _CACHES[path]
@@ -8,15 +8,15 @@ import h5py
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from joblib import Parallel, delayed
 from navicat_volcanic.helpers import bround
 from scipy.integrate import solve_ivp
 from sklearn.experimental import enable_iterative_imputer
 from sklearn.impute import IterativeImputer, KNNImputer, SimpleImputer
-from tqdm import tqdm
 
-from kinetic_solver import calc_k, check_km_inp, system_KE_DE
+from kinetic_solver import (calc_k, calc_k_batch, check_km_inp,
+                            project_non_negative, system_KE_DE)
 from plot_function import plot_3d_contour_regions_np, plot_3d_np
+from worker_pool import run_pool
 
 
 def plot_save(result_solve_ivp, dir, name, states, x_scale, more_species_mkm):
@@ -305,19 +305,32 @@ def load_data(args):
 
 
 def run_mkm(grid, loc, energy_profile_all, dgr_all, coeff_TS_all,
-            rxn_network_all, states, initial_conc):
+            rxn_network_all, states, initial_conc, codegen=False, k_all=None,
+            final_only=False, t_eval=None):
+    """Final target concentrations at cell loc of the temperature-time grid.
 
+    As in calc_km, with ``final_only`` no dense interpolant is built and only
+    the final state, plus the ``t_eval`` samples if given, is kept.
+    """
     idx_target_all = [states.index(i) for i in states if "*" in i]
     temperature = grid[0][0, loc[0]]
     t_span = (0, grid[1][loc[1], 0])
-    initial_conc += 1e-9
-    k_forward_all, k_reverse_all = calc_k(
-        energy_profile_all, dgr_all, coeff_TS_all, temperature)
+    if final_only or t_eval is not None:
+        t_eval = np.union1d([] if t_eval is None else t_eval, [t_span[1]])
+    # not in place, the array is shared by all the tasks of a pool worker
+    initial_conc = initial_conc + 1e-9
+    if k_all is None:
+        k_forward_all, k_reverse_all = calc_k(
+            energy_profile_all, dgr_all, coeff_TS_all, temperature)
+    else:
+        # precomputed for every temperature of the grid
+        k_forward_all, k_reverse_all = k_all[0][loc[0]], k_all[1][loc[0]]
     assert k_forward_all.shape[0] == rxn_network_all.shape[0]
     assert k_reverse_all.shape[0] == rxn_network_all.shape[0]
 
     dydt = system_KE_DE(k_forward_all, k_reverse_all,
-                        rxn_network_all, initial_conc, states)
+                        rxn_network_all, initial_conc, states,
+                        codegen=codegen)
 
     max_step = (t_span[1] - t_span[0]) / 10.0
     first_step = np.min(
@@ -345,13 +358,16 @@ def run_mkm(grid, loc, energy_profile_all, dgr_all, coeff_TS_all,
                 t_span,
                 initial_conc,
                 method="BDF",
-                dense_output=True,
+                dense_output=not final_only,
+                t_eval=t_eval,
                 rtol=rtol,
                 atol=atol,
                 jac=dydt.jac,
                 max_step=max_step,
                 first_step=first_step,
             )
+            project_non_negative(
+                result_solve_ivp, rtol * np.max(initial_conc))
             success = True
             c_target_t = np.array([result_solve_ivp.y[i][-1]
                                   for i in idx_target_all])
@@ -360,7 +376,7 @@ def run_mkm(grid, loc, energy_profile_all, dgr_all, coeff_TS_all,
             if rtol == last_[0] and atol == last_[1]:
                 success = True
                 cont = True
-                return np.array([np.NaN] * len(idx_target_all))
+                return np.array([np.nan] * len(idx_target_all))
             continue
 
 
@@ -433,6 +449,23 @@ if __name__ == "__main__":
         default=1,
         help="number of cpu cores for the parallel computing when calling the map mode(default: 1)",
     )
+    parser.add_argument(
+        "-cg",
+        "--codegen",
+        dest="codegen",
+        action="store_true",
+        help="""Toggle to use rate/Jacobian kernels generated for the network (cached on disk, JIT-compiled if numba is installed). (default: False)""",
+    )
+
+    parser.add_argument(
+        "-v",
+        "--v",
+        "--verb",
+        dest="verb",
+        type=int,
+        default=1,
+        help="Verbosity level of the code. Set to 0 to hide the progress of the map (default: 1)",
+    )
 
     args = parser.parse_args()
     w_dir = args.dir
@@ -440,6 +473,8 @@ if __name__ == "__main__":
     plot_evo = args.plot_evo
     map_tt = args.map
     ncore = args.ncore
+    codegen = args.codegen
+    verb = args.verb
 
     args.i = f"{w_dir}/reaction_data.csv"
     args.c = f"{w_dir}/c0.txt"
@@ -481,36 +516,24 @@ if __name__ == "__main__":
         n_target = len([states.index(i) for i in states if "*" in i])
         grid = np.zeros((npoints, npoints))
         grid_d = np.array([grid] * n_target)
-        total_combinations = len(temperatures_) * len(times_)
         combinations = list(
             itertools.product(
                 range(
                     len(temperatures_)), range(
                     len(times_))))
-        num_chunks = total_combinations // ncore + \
-            (total_combinations % ncore > 0)
-
-        for chunk_index in tqdm(range(num_chunks)):
-            start_index = chunk_index * ncore
-            end_index = min(start_index + ncore, total_combinations)
-            chunk = combinations[start_index:end_index]
-
-            results = Parallel(
-                n_jobs=ncore)(
-                delayed(run_mkm)(
-                    Tts,
-                    loc,
-                    energy_profile_all,
-                    dgr_all,
-                    coeff_TS_all,
-                    rxn_network_all,
-                    states,
-                    initial_conc) for loc in chunk)
-            i = 0
-            for k, l in chunk:
-                for j in range(n_target):
-                    grid_d[j][k, l] = results[i][j]
-                i += 1
+        # rate constants at every temperature of the map in one pass
+        k_forward_T, k_reverse_T = calc_k_batch(
+            energy_profile_all, dgr_all, coeff_TS_all, temperatures_)
+
+        results = run_pool(
+            run_mkm, [(Tts, loc) for loc in combinations], ncore,
+            energy_profile_all, dgr_all, coeff_TS_all, rxn_network_all,
+            states, initial_conc, codegen=codegen,
+            k_all=(k_forward_T[0], k_reverse_T[0]), final_only=True,
+            progress=verb > 0)
+        for i, (k, l) in enumerate(combinations):
+            for j in range(n_target):
+                grid_d[j][k, l] = results[i][j]
 
         # TODO knn imputter for now
         if np.any(np.isnan(grid_d)):
@@ -0,0 +1,197 @@
+import itertools
+import os
+import pickle
+import signal
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
+from joblib.externals.loky import get_reusable_executor
+from joblib.externals.loky.backend.reduction import dump
+from scipy.spatial import cKDTree
+from tqdm import tqdm
+
+# the sweep the worker is on: func, items, shared arguments
+_CONTEXT = {}
+# idle workers are kept this long (s) between sweeps
+IDLE_TIMEOUT = 600
+
+
+class SharedArray:
+    """An array published once in a memory-mapped file.
+
+    Only the file name travels to the workers: run_pool hands them the
+    mapped array (read-only unless ``mode`` is "r+") in place of the handle.
+    """
+
+    def __init__(self, a, folder, name, mode="r"):
+        self.path = os.path.join(folder, f"{name}.mmap")
+        self.shape = a.shape
+        self.dtype = a.dtype.str
+        self.mode = mode
+        mm = np.memmap(self.path, dtype=a.dtype, mode="w+", shape=a.shape)
+        mm[...] = a
+        mm.flush()
+
+    def open(self, mode=None):
+        return np.memmap(self.path, dtype=self.dtype, mode=mode or self.mode,
+                         shape=self.shape)
+
+
+def shared_folder():
+    """Temporary folder for SharedArray files, in RAM (/dev/shm) if possible."""
+    folder = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    return tempfile.TemporaryDirectory(prefix="spectre_", dir=folder)
+
+
+def _open_shared(value):
+    return value.open() if isinstance(value, SharedArray) else value
+
+
+def _init_worker(func, items, args, kwargs, out=None, out_index=None):
+    """Keep the shared arguments of a sweep for its tasks."""
+    _CONTEXT.clear()
+    _CONTEXT.update(
+        func=func, items=items,
+        args=tuple(_open_shared(a) for a in args),
+        kwargs={key: _open_shared(value) for key, value in kwargs.items()},
+        out=None if out is None else out.open("r+"), out_index=out_index)
+
+
+def _init_pool_worker():
+    """Pool initializer: Ctrl-C is left to the parent, which stops the
+    pool."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _run_task(i, context=None):
+    """Solve item i of the sweep, with the CPU time it took.
+
+    In a pool worker the sweep is loaded from the context file on its first
+    task. With a shared output the result is written to it, not sent back.
+    """
+    if context is not None and _CONTEXT.get("path") != context:
+        with open(context, "rb") as f:
+            _init_worker(*pickle.load(f))
+        _CONTEXT["path"] = context
+    ctx = _CONTEXT
+    start = time.process_time()
+    res = ctx["func"](*ctx["items"][i], *ctx["args"], **ctx["kwargs"])
+    if ctx["out"] is not None:
+        ctx["out"][ctx["out_index"][i]] = res
+        res = None
+    return i, res, time.process_time() - start
+
+
+def run_pool(func, items, ncore, *args, cost=None, elapsed=None,
+             out=None, out_index=None, on_result=None, progress=True,
+             **kwargs):
+    """Call func(*item, *args, **kwargs) for all items on ncore workers.
+
+    The worker processes are started once and kept for the following
+    sweeps. func, the items and the shared arguments (network, grids,
+    solver settings) are written once per sweep to a file in shared memory,
+    which every worker reads on its first task; the tasks are only item
+    indices. Idle workers pull the next task from the queue and results are
+    collected as they complete, so a slow item does not hold back the
+    others.
+
+    Parameters
+    ----------
+    cost : array, optional
+        predicted cost of the items, queued longest first (default: as given)
+    elapsed : array, optional
+        filled with the CPU time spent on every item (s)
+    out : SharedArray, optional
+        the workers write the result of item i to out[out_index[i]] and
+        return nothing (the results are then all None)
+    on_result : callable, optional
+        called as on_result(i, result) as soon as item i is done, e.g. to
+        checkpoint it
+    progress : bool
+        show a progress bar and report the core utilisation at the end (if
+        the solves took any CPU time)
+
+    Returns the results in item order.
+    """
+    n = len(items)
+    results = [None] * n
+    timing = np.zeros(n) if elapsed is None else elapsed
+    order = np.arange(n) if cost is None else \
+        np.argsort(-np.nan_to_num(np.asarray(cost, dtype=np.float64),
+                                  nan=-np.inf), kind="stable")
+    n_worker = max(1, min(ncore, n))
+    start = time.perf_counter()
+    if n_worker == 1:
+        _init_worker(func, items, args, kwargs, out, out_index)
+        try:
+            for i in tqdm(order, ncols=80, disable=not progress):
+                _, results[i], timing[i] = _run_task(i)
+                if on_result is not None:
+                    on_result(i, results[i])
+        finally:
+            _CONTEXT.clear()
+    else:
+        executor = get_reusable_executor(
+            max_workers=max(1, ncore), timeout=IDLE_TIMEOUT,
+            initializer=_init_pool_worker)
+        with shared_folder() as folder:
+            context = os.path.join(folder, "context.pkl")
+            with open(context, "wb") as f:
+                # loky's pickler, which also handles functions of __main__
+                dump((func, items, args, kwargs, out, out_index), f)
+            # a couple of tasks per worker are queued at any time, the next
+            # one is submitted as soon as one is done
+            queue = iter(order)
+            running = {executor.submit(_run_task, i, context)
+                       for i in itertools.islice(queue, 2 * n_worker)}
+            try:
+                with tqdm(total=n, ncols=80, disable=not progress) as bar:
+                    while running:
+                        finished, running = wait(
+                            running, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            i, res, timing[i] = future.result()
+                            results[i] = res
+                            if on_result is not None:
+                                on_result(i, res)
+                            bar.update()
+                        running |= {executor.submit(_run_task, i, context)
+                                    for i in itertools.islice(
+                                        queue, len(finished))}
+            except BaseException:
+                # e.g. Ctrl-C: drop the rest of the queue, the next sweep
+                # starts a new pool
+                executor.shutdown(kill_workers=True)
+                raise
+    wall = time.perf_counter() - start
+    if progress and timing.sum() > 0:
+        print(f"Core utilisation: {timing.sum() / (n_worker * wall):.0%} "
+              f"({timing.sum():.1f} CPU s of solves in {wall:.1f} s "
+              f"on {n_worker} cores)")
+    return results
+
+
+def nearest_cost(points, elapsed, query):
+    """Cost of new points predicted by the time of their nearest solved one.
+
+    Parameters
+    ----------
+    points : (n, dim) array
+        (grid) coordinates of the solved points
+    elapsed : (n,) array
+        their solve times, NaN where unknown
+    query : (m, dim) array
+        coordinates of the points to predict
+
+    Returns None if no solve time is known yet.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(len(elapsed), -1)
+    known = np.isfinite(elapsed)
+    if not known.any():
+        return None
+    tree = cKDTree(points[known])
+    _, nearest = tree.query(
+        np.asarray(query, dtype=np.float64).reshape(-1, points.shape[1]))
+    return np.asarray(elapsed)[known][nearest]